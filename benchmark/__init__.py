@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks of gsmtpd
+
+Run them from the repository root, e.g. ``python -m benchmark.transcode``
+"""
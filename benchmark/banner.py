@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Connect-to-banner latency, resolving the hostname once per server against
+resolving it for every connection as SMTPChannel used to
+
+    python -m benchmark.banner [connections] [concurrency]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import time
+
+import gevent
+from gevent import socket
+
+from gsmtpd.server import SMTPServer
+
+
+class PerConnectionServer(SMTPServer):
+
+    @property
+    def fqdn(self):
+        return socket.getfqdn()
+
+
+def banner(port):
+    start = time.time()
+    conn = socket.create_connection(('127.0.0.1', port))
+    try:
+        data = ''
+        while not data.endswith('\r\n'):
+            data += conn.recv(1024)
+        assert data.startswith('220 ')
+    finally:
+        conn.close()
+    return time.time() - start
+
+
+def run(server_class, connections, concurrency):
+    server = server_class(('127.0.0.1', 0))
+    server.start()
+    latencies = []
+
+    def client(n):
+        for _ in xrange(n):
+            latencies.append(banner(server.server_port))
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(client, connections // concurrency)
+                    for _ in xrange(concurrency)])
+    elapsed = time.time() - start
+    server.stop()
+
+    latencies.sort()
+    pick = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+    print '%-20s %8.0f conn/s  p50 %7.3f ms  p99 %7.3f ms' % (
+        server_class.__name__, len(latencies) / elapsed,
+        pick(0.5) * 1000, pick(0.99) * 1000)
+
+
+def main(connections=2000, concurrency=50):
+    print 'getfqdn() resolves to %s' % socket.getfqdn()
+    for server_class in (PerConnectionServer, SMTPServer):
+        run(server_class, connections, concurrency)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
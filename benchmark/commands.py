@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Commands per second of :class:`gsmtpd.channel.SMTPChannel` fed from memory,
+the old getattr dispatch against the class dispatch table
+
+    python -m benchmark.commands [transactions] [chunk size]
+"""
+
+import sys
+import time
+
+from benchmark.memory import MemorySocket, split
+from gsmtpd.channel import SMTPChannel, EMPTYSTRING, logger
+from gsmtpd.server import SMTPServer
+
+TRANSACTION = ('MAIL FROM:<sender@gsmtpd.org>\r\n'
+               'RCPT TO:<rcpt@gsmtpd.org>\r\n'
+               'RCPT TO:<other@gsmtpd.org>\r\n'
+               'RSET\r\n'
+               'NOOP\r\n')
+COMMANDS = TRANSACTION.count('\r\n')
+
+
+class Server(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+class GetattrChannel(SMTPChannel):
+    """What SMTPChannel.found_terminator did before the dispatch table"""
+
+    def found_terminator(self):
+        if self.state != self.COMMAND:
+            return SMTPChannel.found_terminator(self)
+        line = EMPTYSTRING.join(self.line)
+        self.line = []
+        self.line_size = 0
+        if not line:
+            self.push('500 Error: bad syntax')
+            return
+        i = line.find(' ')
+        if i < 0:
+            command = line.upper().strip()
+            arg = None
+        else:
+            command = line[:i].upper()
+            arg = line[i+1:].strip()
+        if self.pending_rcpts and command != 'RCPT':
+            self.resolve_rcpts()
+        method = getattr(self, 'smtp_' + command, None)
+        logger.debug('%s:%s', command, arg)
+        if not method:
+            self.push('502 Error: command "%s" not implemented' % command)
+            return
+        method(arg)
+
+    def push(self, msg):
+        logger.debug('PUSH %s', msg)
+        self.ac_out_buffer.append(msg)
+
+
+def run(label, channel_class, server, transactions, chunk_size):
+    data = 'EHLO client.gsmtpd.org\r\n' + TRANSACTION * transactions + 'QUIT\r\n'
+    conn = MemorySocket(split(data, chunk_size))
+    start = time.time()
+    channel = channel_class(server, conn, conn.getpeername(),
+                            server.data_size_limit)
+    while not channel.closed:
+        channel.handle_read()
+    elapsed = time.time() - start
+    print '%-18s %10.0f commands/s  %6.2f us/command' % (
+        label, transactions * COMMANDS / elapsed,
+        elapsed * 1e6 / (transactions * COMMANDS))
+
+
+def main(transactions=20000, chunk_size=4096):
+    server = Server(('127.0.0.1', 0), hostname='mx.gsmtpd.org')
+    for _ in xrange(3):
+        run('getattr dispatch', GetattrChannel, server, transactions, chunk_size)
+        run('dispatch table', SMTPChannel, server, transactions, chunk_size)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
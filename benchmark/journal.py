@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Acknowledged messages per second of :class:`gsmtpd.journal.Journal` for
+several group-commit windows, against one fsync per message
+
+    python -m benchmark.journal [messages] [concurrency] [message size]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import shutil
+import sys
+import tempfile
+import time
+
+import gevent
+
+from gsmtpd.journal import Journal
+
+PEER = ('127.0.0.1', 2525)
+
+
+def run(label, messages, concurrency, size, commit_window):
+    directory = tempfile.mkdtemp(prefix='gsmtpd-bench-')
+    data = 'x' * size
+    try:
+        journal = Journal(directory, commit_window)
+        journal.recover()
+
+        def session(n):
+            for _ in xrange(n):
+                journal.ack(journal.append(PEER, 'from@gsmtpd.org',
+                                           ['to@gsmtpd.org'], data))
+
+        start = time.time()
+        gevent.joinall([gevent.spawn(session, messages // concurrency)
+                        for _ in xrange(concurrency)])
+        elapsed = time.time() - start
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+    done = messages // concurrency * concurrency
+    print '%-22s %8.0f msg/s  %6d fsync  %6.1f msg/fsync' % (
+        label, done / elapsed, journal.commits,
+        done / float(journal.commits or 1))
+
+
+def main(messages=2000, concurrency=100, size=4096):
+    run('fsync per message', messages // 10, 1, size, 0)
+    for window in (0, 0.001, 0.002, 0.005, 0.01, 0.02):
+        run('window %.3fs' % window, messages, concurrency, size, window)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
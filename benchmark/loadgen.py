@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+SMTP load generator, raw sockets on gevent
+
+    python -m benchmark.loadgen [options]
+
+Opens `--sessions` concurrent sessions which send `--messages` messages of
+`--size` bytes each, optionally with the envelope pipelined (RFC 2920) or
+over STARTTLS, and prints the throughput and the p50/p95/p99 latency of
+every phase as JSON:
+
+    connect   from connect() to the banner
+    ehlo      EHLO, or HELO when the server does not know EHLO
+    starttls  STARTTLS and the handshake
+    envelope  MAIL and RCPT, one round trip when pipelined
+    data      DATA, the message and the final reply
+    message   envelope and data together
+    quit      QUIT
+
+`--processes` splits the sessions among several client processes, one
+gevent process may not be able to keep a server busy.
+
+Without `--port` the server runs in a subprocess on loopback, `--target`
+picks gsmtpd, the asyncore based `smtpd` of the standard library (the
+baseline of the charts in the README, it knows neither EHLO nor STARTTLS)
+or both one after the other.  Latencies are in milliseconds.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import gevent
+from gevent import socket, ssl
+
+CERTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
+PHASES = ('connect', 'ehlo', 'starttls', 'envelope', 'data', 'message', 'quit')
+
+
+def serve(target, port, tls=False):
+    if target == 'smtpd':
+        import asyncore
+        import smtpd
+
+        class NullServer(smtpd.SMTPServer):
+
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                pass
+
+        server = NullServer(('127.0.0.1', port), None)
+        # its backlog of 5 drops concurrent connects, measure the rest
+        server.listen(1024)
+        asyncore.loop()
+        return
+
+    from gsmtpd.server import SMTPServer
+
+    class NullServer(SMTPServer):
+
+        def process_message(self, peer, mailfrom, rcpttos, data):
+            pass
+
+    kwargs = {}
+    if tls:
+        kwargs = dict(keyfile=os.path.join(CERTS, 'server.key'),
+                      certfile=os.path.join(CERTS, 'server.crt'))
+    NullServer(('127.0.0.1', port), timeout=180, **kwargs).serve_forever()
+
+
+class SMTPError(Exception):
+    pass
+
+
+class Client(object):
+    """Blocking (in the greenlet) SMTP client over a raw socket"""
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = ''
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def reply(self):
+        """Read one reply, return its code"""
+        while True:
+            end = self.buffer.find('\r\n')
+            while end < 0:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise SMTPError('connection closed by the server')
+                self.buffer += data
+                end = self.buffer.find('\r\n')
+            line, self.buffer = self.buffer[:end], self.buffer[end + 2:]
+            if line[3:4] != '-':
+                return int(line[:3])
+
+    def command(self, line, expect):
+        self.send(line + '\r\n')
+        code = self.reply()
+        if code != expect:
+            raise SMTPError('%s: %d' % (line.split(' ', 1)[0], code))
+        return code
+
+    def starttls(self, context):
+        self.command('STARTTLS', 220)
+        self.sock = context.wrap_socket(self.sock)
+        self.buffer = ''
+
+    def close(self):
+        self.sock.close()
+
+
+def message_data(size):
+    header = 'From: <bench@gsmtpd.org>\r\nSubject: load\r\n\r\n'
+    line = 'x' * 76 + '\r\n'
+    body = line * max((size - len(header)) // len(line), 0)
+    return header + body + 'x' * max(size - len(header) - len(body), 0)
+
+
+def session(options, latencies, counters, context, data):
+    clock = time.time
+    started = clock()
+    client = None
+    try:
+        client = Client(options.host, options.port, options.timeout)
+        if client.reply() != 220:
+            raise SMTPError('no banner')
+        now = clock()
+        latencies['connect'].append(now - started)
+
+        started = now
+        client.send('EHLO loadgen.gsmtpd.org\r\n')
+        if client.reply() != 250:
+            client.command('HELO loadgen.gsmtpd.org', 250)
+        now = clock()
+        latencies['ehlo'].append(now - started)
+
+        if context is not None:
+            started = now
+            client.starttls(context)
+            client.command('EHLO loadgen.gsmtpd.org', 250)
+            now = clock()
+            latencies['starttls'].append(now - started)
+
+        for _ in xrange(options.messages):
+            begin = now
+            if options.pipelining:
+                client.send('MAIL FROM:<bench@gsmtpd.org>\r\n'
+                            'RCPT TO:<sink@gsmtpd.org>\r\nDATA\r\n')
+                codes = (client.reply(), client.reply(), client.reply())
+                if codes != (250, 250, 354):
+                    raise SMTPError('envelope: %s' % (codes,))
+                now = clock()
+                latencies['envelope'].append(now - begin)
+                started = now
+            else:
+                client.command('MAIL FROM:<bench@gsmtpd.org>', 250)
+                client.command('RCPT TO:<sink@gsmtpd.org>', 250)
+                now = clock()
+                latencies['envelope'].append(now - begin)
+                started = now
+                client.command('DATA', 354)
+            client.send(data)
+            if client.reply() != 250:
+                raise SMTPError('message refused')
+            now = clock()
+            latencies['data'].append(now - started)
+            latencies['message'].append(now - begin)
+            counters['messages'] += 1
+
+        started = now
+        client.command('QUIT', 221)
+        latencies['quit'].append(clock() - started)
+    except (socket.error, SMTPError) as err:
+        counters['errors'] += 1
+        counters['last_error'] = str(err)
+    finally:
+        if client is not None:
+            client.close()
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)] * 1000
+    return dict(count=len(values), p50=pick(0.5), p95=pick(0.95),
+                p99=pick(0.99), max=values[-1] * 1000)
+
+
+def generate(options):
+    """Run the sessions in this process, return the raw latencies"""
+    context = None
+    if options.starttls:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_NONE
+    # dot-stuffed already, every line starts with a letter
+    data = message_data(options.size) + '\r\n.\r\n'
+    latencies = dict((phase, []) for phase in PHASES)
+    counters = dict(messages=0, errors=0)
+
+    started = time.time()
+    gevent.joinall([gevent.spawn(session, options, latencies, counters,
+                                 context, data)
+                    for _ in xrange(options.sessions)])
+    counters.update(latencies=latencies, started=started,
+                    finished=time.time())
+    return counters
+
+
+def generate_in_processes(options):
+    """Split the sessions among `--processes` client processes"""
+    argv = [sys.executable, '-m', 'benchmark.loadgen', '--generate',
+            '--host', options.host, '--port', str(options.port),
+            '--messages', str(options.messages), '--size', str(options.size),
+            '--timeout', str(options.timeout)]
+    if options.pipelining:
+        argv.append('--pipelining')
+    if options.starttls:
+        argv.append('--starttls')
+    procs = []
+    for index in xrange(options.processes):
+        sessions = options.sessions // options.processes
+        if index < options.sessions % options.processes:
+            sessions += 1
+        procs.append(subprocess.Popen(argv + ['--sessions', str(sessions)],
+                                      stdout=subprocess.PIPE))
+    parts = [json.loads(proc.communicate()[0]) for proc in procs]
+    merged = dict(messages=0, errors=0,
+                  latencies=dict((phase, []) for phase in PHASES),
+                  started=min(part['started'] for part in parts),
+                  finished=max(part['finished'] for part in parts))
+    for part in parts:
+        merged['messages'] += part['messages']
+        merged['errors'] += part['errors']
+        if 'last_error' in part:
+            merged['last_error'] = part['last_error']
+        for phase, values in part['latencies'].iteritems():
+            merged['latencies'][phase].extend(values)
+    return merged
+
+
+def run(options):
+    if options.processes > 1:
+        raw = generate_in_processes(options)
+    else:
+        raw = generate(options)
+    elapsed = raw['finished'] - raw['started']
+    result = dict(target=options.target, host=options.host, port=options.port,
+                  sessions=options.sessions, messages=raw['messages'],
+                  size=options.size, pipelining=options.pipelining,
+                  starttls=options.starttls, processes=options.processes,
+                  errors=raw['errors'], elapsed=elapsed,
+                  messages_per_second=raw['messages'] / elapsed,
+                  phases=dict((phase, percentiles(values))
+                              for phase, values in raw['latencies'].iteritems()
+                              if values))
+    if 'last_error' in raw:
+        result['last_error'] = raw['last_error']
+    return result
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_against(target, options):
+    port = free_port()
+    argv = [sys.executable, '-m', 'benchmark.loadgen', '--serve', target,
+            str(port)]
+    if options.starttls:
+        argv.append('tls')
+    server = subprocess.Popen(argv)
+    try:
+        for _ in xrange(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        options.host, options.port, options.target = '127.0.0.1', port, target
+        return run(options)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark.loadgen',
+        description='SMTP load generator, prints the results as JSON')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int,
+                        help='port of a running server, default starts one')
+    parser.add_argument('--target', choices=('gsmtpd', 'smtpd', 'both'),
+                        default='gsmtpd',
+                        help='server started without --port, both compares '
+                             'gsmtpd against the stdlib smtpd')
+    parser.add_argument('--sessions', type=int, default=100,
+                        help='concurrent sessions')
+    parser.add_argument('--messages', type=int, default=10,
+                        help='messages per session')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='bytes per message')
+    parser.add_argument('--pipelining', action='store_true',
+                        help='send MAIL, RCPT and DATA in one write')
+    parser.add_argument('--starttls', action='store_true')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='socket timeout in seconds')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='client processes sharing the sessions, one '
+                             'process may not be able to saturate the server')
+    parser.add_argument('--output', help='file to write the JSON to')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    if options.port:
+        options.target = 'external'
+        results = [run(options)]
+    elif options.target == 'both':
+        if options.starttls:
+            sys.exit('the stdlib smtpd does not support STARTTLS')
+        results = [run_against(target, options)
+                   for target in ('smtpd', 'gsmtpd')]
+    else:
+        if options.starttls and options.target == 'smtpd':
+            sys.exit('the stdlib smtpd does not support STARTTLS')
+        results = [run_against(options.target, options)]
+    output = json.dumps(results if len(results) > 1 else results[0],
+                        indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print output
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[3]), sys.argv[4:5] == ['tls'])
+    elif sys.argv[1:2] == ['--generate']:
+        print json.dumps(generate(parse_args(sys.argv[2:])))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+In-memory socket to feed :class:`gsmtpd.channel.SMTPChannel` without the
+network, shared by the benchmarks of the protocol handling
+"""
+
+
+def split(stream, size):
+    """Cut `stream` into the reads of `size` bytes a socket would return"""
+    return [stream[i:i + size] for i in xrange(0, len(stream), size)]
+
+
+class MemorySocket(object):
+    """Returns the given chunks one per read, counts the bytes sent"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.index = 0
+        self.sent = 0
+        self.closed = False
+
+    def getpeername(self):
+        return ('127.0.0.1', 2525)
+
+    def recv_into(self, view, size):
+        if self.index == len(self.chunks):
+            return 0
+        chunk = self.chunks[self.index]
+        if len(chunk) > size:
+            # the channel asked for less, keep the rest for the next read
+            self.chunks[self.index] = chunk[size:]
+            chunk = chunk[:size]
+        else:
+            self.index += 1
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cost of the protocol parser, :meth:`SMTPChannel.handle_read` with
+`found_terminator` and `collect_incoming_data`, without the network
+
+    python -m benchmark.parser [--save FILE] [--compare FILE] [--stream FILE]
+
+Every scenario is a byte stream cut into the reads a socket would return,
+fed to a channel over an in-memory socket:
+
+    commands          pipelined envelopes, RSET and NOOP in 4 KB reads
+    tiny_reads        the same stream in 7 byte reads
+    data_small        500 messages of 2 KB with dot-stuffed lines
+    data_large        one 8 MB message with DATA in 64 KB reads
+    bdat_large        the same message in 64 KB BDAT chunks
+    split_terminator  messages whose every CRLF and end of data marker is
+                      cut between two reads
+
+`--stream FILE` adds a recorded session (the bytes a client sent) read in
+`--chunk` byte pieces.  Each scenario runs in its own process, reporting
+the best of `--repeat` runs in ns/byte, the growth of the peak RSS (KB on
+Linux) and, on interpreters with :mod:`tracemalloc` (pytracemalloc on 2.7),
+the peak of the memory allocated during a run and the number of blocks it
+left allocated.  `--save` stores the results with the version
+they were measured on, `--compare` prints them next to stored ones.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from benchmark.memory import MemorySocket, split
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+
+def envelope(rcpts=1):
+    return ('MAIL FROM:<sender@gsmtpd.org>\r\n' +
+            'RCPT TO:<rcpt@gsmtpd.org>\r\n' * rcpts)
+
+
+def body(size):
+    header = 'From: <sender@gsmtpd.org>\r\nSubject: parser\r\n\r\n'
+    lines = ['Lorem ipsum dolor sit amet, consectetur adipiscing elit\r\n'] * 9
+    lines.append('..a stuffed line starting with a dot\r\n')
+    block = ''.join(lines)
+    text = header + block * max((size - len(header)) // len(block), 1)
+    return text
+
+
+def commands(size):
+    stream = ('EHLO client.gsmtpd.org\r\n' +
+              (envelope(2) + 'RSET\r\nNOOP\r\n') * 2000 + 'QUIT\r\n')
+    return split(stream, size)
+
+
+def data_messages(count, size):
+    message = envelope() + 'DATA\r\n' + body(size) + '.\r\n'
+    return 'EHLO client.gsmtpd.org\r\n' + message * count + 'QUIT\r\n'
+
+
+def bdat_message(size, chunk):
+    data = body(size)
+    parts = ['EHLO client.gsmtpd.org\r\n', envelope()]
+    for offset in xrange(0, len(data), chunk):
+        piece = data[offset:offset + chunk]
+        last = ' LAST' if offset + chunk >= len(data) else ''
+        parts.append('BDAT %d%s\r\n' % (len(piece), last))
+        parts.append(piece)
+    parts.append('QUIT\r\n')
+    return split(''.join(parts), chunk)
+
+
+def split_terminators(stream):
+    """Cut the stream inside every CRLF, and at a different place inside
+    every end of data marker"""
+    chunks = []
+    start = 0
+    shift = 0
+    index = stream.find('\r\n')
+    while index >= 0:
+        if stream.startswith('\r\n.\r\n', index):
+            shift = shift % 4 + 1
+            cut = index + shift
+            index += 5
+        else:
+            cut = index + 1
+            index += 2
+        chunks.append(stream[start:cut])
+        start = cut
+        index = stream.find('\r\n', index)
+    chunks.append(stream[start:])
+    return [chunk for chunk in chunks if chunk]
+
+
+SCENARIOS = {
+    'commands': lambda: commands(4096),
+    'tiny_reads': lambda: commands(7),
+    'data_small': lambda: split(data_messages(500, 2048), 4096),
+    'data_large': lambda: split(data_messages(1, 8 * MB), 64 * 1024),
+    'bdat_large': lambda: bdat_message(8 * MB, 64 * 1024),
+    'split_terminator': lambda: split_terminators(data_messages(200, 1024)),
+}
+ORDER = ['commands', 'tiny_reads', 'data_small', 'data_large', 'bdat_large',
+         'split_terminator']
+
+
+def feed(server, chunks):
+    from gsmtpd.channel import SMTPChannel
+    conn = MemorySocket(chunks)
+    channel = SMTPChannel(server, conn, conn.getpeername(),
+                          server.data_size_limit)
+    while not channel.closed:
+        channel.handle_read()
+    return server.messages
+
+
+def measure(chunks, repeat):
+    """Run in a process of its own, so that the peak RSS is this scenario's"""
+    from gsmtpd.server import SMTPServer
+
+    class NullServer(SMTPServer):
+
+        def process_message(self, peer, mailfrom, rcpttos, data):
+            self.messages += 1
+
+    server = NullServer(('127.0.0.1', 0), hostname='mx.gsmtpd.org',
+                        data_size_limit=64 * MB)
+    server.messages = 0
+    size = sum(len(chunk) for chunk in chunks)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in xrange(repeat):
+        started = time.time()
+        feed(server, chunks)
+        times.append(time.time() - started)
+    result = dict(bytes=size, reads=len(chunks),
+                  messages=server.messages // repeat,
+                  best=min(times), median=sorted(times)[len(times) // 2],
+                  ns_per_byte=min(times) * 1e9 / size,
+                  peak_rss_kb=resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss - rss,
+                  traced_peak=None, traced_blocks=None)
+    try:
+        import tracemalloc
+    except ImportError:
+        return result
+    tracemalloc.start()
+    feed(server, chunks)
+    result['traced_peak'] = tracemalloc.get_traced_memory()[1]
+    result['traced_blocks'] = sum(stat.count for stat in
+                                  tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    return result
+
+
+def run(name, repeat, stream=None, chunk=4096):
+    argv = [sys.executable, '-m', 'benchmark.parser', '--measure', name,
+            str(repeat)]
+    if stream:
+        argv += [stream, str(chunk)]
+    output = subprocess.check_output(argv, cwd=ROOT)
+    return json.loads(output)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                                        '--dirty'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, stored=None):
+    old = stored['results'] if stored else {}
+    if stored:
+        print 'compared with %s %s' % (stored['version'], stored['revision'])
+    print '%-18s %9s %9s %8s %10s %8s' % ('scenario', 'MB', 'ns/byte',
+                                          'change', 'peak KB', 'msgs')
+    for name, result in results:
+        change = ''
+        if name in old:
+            change = '%+7.1f%%' % ((result['ns_per_byte'] /
+                                    old[name]['ns_per_byte'] - 1) * 100)
+        print '%-18s %9.2f %9.2f %8s %10d %8d' % (
+            name, result['bytes'] / float(MB), result['ns_per_byte'], change,
+            result['peak_rss_kb'], result['messages'])
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m benchmark.parser')
+    parser.add_argument('scenarios', nargs='*',
+                        help='some of %s, default runs them all' %
+                             ', '.join(ORDER))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--stream', help='file of recorded client bytes')
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='read size of --stream')
+    parser.add_argument('--save', help='file to store the results in')
+    parser.add_argument('--compare', help='file of stored results')
+    options = parser.parse_args(argv)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s' % name)
+
+    results = [(name, run(name, options.repeat))
+               for name in options.scenarios or ORDER]
+    if options.stream:
+        results.append((os.path.basename(options.stream),
+                        run('stream', options.repeat, options.stream,
+                            options.chunk)))
+    stored = None
+    if options.compare:
+        with open(options.compare) as f:
+            stored = json.load(f)
+    report(results, stored)
+    if options.save:
+        from gsmtpd import __version__
+        with open(options.save, 'w') as f:
+            json.dump(dict(version=__version__, revision=revision(),
+                           python=sys.version.split()[0],
+                           results=dict(results)), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        name, repeat = sys.argv[2], int(sys.argv[3])
+        if name == 'stream':
+            with open(sys.argv[4], 'rb') as f:
+                chunks = split(f.read(), int(sys.argv[5]))
+        else:
+            chunks = SCENARIOS[name]()
+        print json.dumps(measure(chunks, repeat))
+    else:
+        main(sys.argv[1:])
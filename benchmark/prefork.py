@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Messages per second against the number of worker processes of
+:class:`gsmtpd.prefork.PreforkServer`
+
+    python -m benchmark.prefork [max workers] [seconds] [client processes] [sessions per client]
+
+Server and clients run as separate processes, the clients speak raw SMTP
+over loopback and send one small message after another.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import multiprocessing
+import signal
+import subprocess
+import sys
+import time
+
+import gevent
+from gevent import socket
+
+MESSAGE = 'Subject: benchmark\r\n\r\n' + 'x' * 1000 + '\r\n'
+
+
+def serve(port, workers):
+    from gsmtpd.server import SMTPServer
+    from gsmtpd.prefork import PreforkServer
+
+    class NullServer(SMTPServer):
+
+        def process_message(self, peer, mailfrom, rcpttos, data):
+            pass
+
+    PreforkServer(NullServer(('127.0.0.1', port)), workers=workers).serve_forever()
+
+
+def session(port, deadline, counter):
+    sock = socket.create_connection(('127.0.0.1', port))
+    reader = sock.makefile('rb')
+
+    def command(line):
+        if line is not None:
+            sock.sendall(line + '\r\n')
+        while True:
+            reply = reader.readline()
+            if reply[3:4] != '-':
+                return reply
+
+    command(None)
+    command('EHLO bench.example')
+    while time.time() < deadline:
+        command('MAIL FROM:<bench@example.com>')
+        command('RCPT TO:<sink@example.com>')
+        command('DATA')
+        assert command(MESSAGE + '.').startswith('250')
+        counter[0] += 1
+    command('QUIT')
+    sock.close()
+
+
+def client(port, seconds, sessions):
+    counter = [0]
+    deadline = time.time() + seconds
+    gevent.joinall([gevent.spawn(session, port, deadline, counter)
+                    for _ in xrange(sessions)])
+    print counter[0]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def measure(workers, seconds, clients, sessions):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'benchmark.prefork',
+                               '--serve', str(port), str(workers)])
+    try:
+        for _ in xrange(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        procs = [subprocess.Popen([sys.executable, '-m', 'benchmark.prefork',
+                                   '--client', str(port), str(seconds),
+                                   str(sessions)], stdout=subprocess.PIPE)
+                 for _ in xrange(clients)]
+        total = sum(int(proc.communicate()[0]) for proc in procs)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return total / float(seconds)
+
+
+def main(max_workers=multiprocessing.cpu_count(), seconds=5, clients=None,
+         sessions=50):
+    clients = clients or max(max_workers, 2)
+    workers, base = 1, None
+    print '%d client processes with %d sessions each' % (clients, sessions)
+    while workers <= max_workers:
+        rate = measure(workers, seconds, clients, sessions)
+        base = base or rate
+        print '%3d workers %10.0f msg/s %6.2fx' % (workers, rate, rate / base)
+        workers *= 2
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(*[int(arg) for arg in sys.argv[2:]])
+    elif sys.argv[1:2] == ['--client']:
+        client(*[int(arg) for arg in sys.argv[2:]])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Messages per second through :class:`gsmtpd.server.PureProxy`, a new
+upstream connection per message against the connection pool
+
+    python -m benchmark.proxy [messages] [concurrency]
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import smtplib
+import sys
+import time
+
+import gevent
+
+from gsmtpd.server import SMTPServer, PureProxy
+
+
+class Upstream(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+class ConnectPerMessageProxy(PureProxy):
+
+    def _deliver(self, mailfrom, rcpttos, data):
+        s = smtplib.SMTP(*self.upstream)
+        try:
+            return s.sendmail(mailfrom, rcpttos, data)
+        finally:
+            s.quit()
+
+
+def run(proxy_class, messages, concurrency):
+    upstream = Upstream(('127.0.0.1', 0))
+    upstream.start()
+    proxy = proxy_class(('127.0.0.1', 0),
+                        upstream=('127.0.0.1', upstream.server_port))
+    proxy.start()
+
+    def client(n):
+        sm = smtplib.SMTP('127.0.0.1', proxy.server_port)
+        for _ in xrange(n):
+            sm.sendmail('from@gsmtpd.org', ['to@gsmtpd.org'],
+                        'Subject: benchmark\r\n\r\n' + 'x' * 1024)
+        sm.quit()
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(client, messages // concurrency)
+                    for _ in xrange(concurrency)])
+    elapsed = time.time() - start
+    proxy.stop()
+    upstream.stop()
+    print '%-24s %8.0f msg/s' % (proxy_class.__name__,
+                                 messages // concurrency * concurrency / elapsed)
+
+
+def main(messages=2000, concurrency=20):
+    for proxy_class in (ConnectPerMessageProxy, PureProxy):
+        run(proxy_class, messages, concurrency)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
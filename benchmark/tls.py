@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+STARTTLS handshakes per second: a context built for every connection
+from the settings as SMTPChannel used to, the shared SSLContext of the
+server, and the shared context with clients resuming their sessions
+
+    python -m benchmark.tls [connections] [client threads]
+
+The client runs in a Python 3 subprocess, set PYTHON3 to its interpreter.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+
+from gevent import ssl, subprocess
+
+from gsmtpd.server import SMTPServer
+
+CERTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tls_client.py')
+
+
+class PerConnectionServer(SMTPServer):
+
+    def wrap_ssl(self, sock):
+        return ssl.wrap_socket(sock, **self.ssl)
+
+
+def run(label, server_class, connections, threads, resume):
+    server = server_class(('127.0.0.1', 0),
+                          keyfile=os.path.join(CERTS, 'server.key'),
+                          certfile=os.path.join(CERTS, 'server.crt'))
+    server.start()
+    env = dict(os.environ)
+    env.pop('PYENV_VERSION', None)
+    output = subprocess.check_output(
+        [os.environ.get('PYTHON3', 'python3'), CLIENT, str(server.server_port),
+         str(connections), str(threads), str(int(resume))], env=env)
+    server.stop()
+    rate, reused = output.split()
+    print '%-28s %8.1f handshakes/s  %5s resumed' % (label, float(rate), reused)
+
+
+def main(connections=1000, threads=4):
+    run('context per connection', PerConnectionServer, connections, threads, False)
+    run('shared context', SMTPServer, connections, threads, False)
+    run('shared context, resumption', SMTPServer, connections, threads, True)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
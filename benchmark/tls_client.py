@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+STARTTLS client of :mod:`benchmark.tls`, run with Python 3 which can hand
+a TLS session to the next connection
+
+    python3 benchmark/tls_client.py port connections threads resume
+"""
+
+import socket
+import ssl
+import sys
+import threading
+import time
+
+
+def command(sock, reader, line):
+    if line is not None:
+        sock.sendall(line + b'\r\n')
+    while True:
+        reply = reader.readline()
+        if reply[3:4] != b'-':
+            return reply
+
+
+def session(port, context, session):
+    sock = socket.create_connection(('127.0.0.1', port))
+    reader = sock.makefile('rb')
+    command(sock, reader, None)
+    command(sock, reader, b'EHLO bench.example')
+    assert command(sock, reader, b'STARTTLS').startswith(b'220')
+    sock = context.wrap_socket(sock, session=session)
+    reader = sock.makefile('rb')
+    # the reply also brings the TLS 1.3 tickets
+    command(sock, reader, b'EHLO bench.example')
+    command(sock, reader, b'QUIT')
+    reused = sock.session_reused
+    session = sock.session
+    sock.close()
+    return session, reused
+
+
+def main(port, connections, threads, resume):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    reused = [0]
+
+    def client(n):
+        last = None
+        for _ in range(n):
+            last, hit = session(port, context, last if resume else None)
+            reused[0] += hit
+
+    workers = [threading.Thread(target=client, args=(connections // threads,))
+               for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    sys.stdout.write('%.1f %d\n' % (connections // threads * threads / elapsed,
+                                    reused[0]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
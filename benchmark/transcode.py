@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+De-transparency of message data, the old line by line loop and the
+chunks done with two :meth:`str.replace` against :mod:`gsmtpd.transcode`
+
+    python -m benchmark.transcode [size in MB] [chunk size]
+"""
+
+import base64
+import os
+import sys
+import timeit
+
+from gsmtpd.transcode import unstuff, Unstuffer
+
+
+def line_loop(chunks):
+    # what SMTPChannel.found_terminator did before
+    data = []
+    for text in ''.join(chunks).split('\r\n'):
+        if text and text[0] == '.':
+            data.append(text[1:])
+        else:
+            data.append(text)
+    return '\n'.join(data)
+
+
+def replace_chunks(chunks):
+    # the first Unstuffer, the line endings of every chunk in two replaces
+    out = []
+    bol = True
+    for chunk in chunks:
+        if bol and chunk[:1] == '.':
+            chunk = chunk[1:]
+        bol = chunk[-2:] == '\r\n'
+        out.append(chunk.replace('\r\n.', '\r\n').replace('\r\n', '\n'))
+    return ''.join(out)
+
+
+def streaming(chunks):
+    unstuffer = Unstuffer()
+    out = [unstuffer.feed(chunk) for chunk in chunks]
+    out.append(unstuffer.flush())
+    return ''.join(out)
+
+
+def text_message(size):
+    line = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit sed do\r\n'
+    stuffed = '..stuffed line that starts with a dot\r\n'
+    block = line * 9 + stuffed
+    return (block * (size // len(block) + 1))[:size]
+
+
+def base64_message(size):
+    encoded = base64.encodestring(os.urandom(size * 3 // 4 + 3))
+    return encoded.replace('\n', '\r\n')[:size]
+
+
+def main(size=10, chunk_size=4096):
+    for kind, make in [('text', text_message), ('base64', base64_message)]:
+        data = make(size * 1024 * 1024)
+        chunks = [data[i:i + chunk_size]
+                  for i in xrange(0, len(data), chunk_size)]
+        assert line_loop(chunks) == unstuff(data) == streaming(chunks)
+
+        cases = [('line loop', lambda: line_loop(chunks)),
+                 ('replace', lambda: replace_chunks(chunks)),
+                 ('unstuff', lambda: unstuff(data)),
+                 ('Unstuffer', lambda: streaming(chunks))]
+        base = None
+        print '%d MB %s message in %d byte chunks' % (size, kind, chunk_size)
+        for name, func in cases:
+            best = min(timeit.repeat(func, number=1, repeat=5))
+            base = base or best
+            print '    %-12s %8.2f ms %8.1f MB/s %6.2fx' % (
+                name, best * 1000, size / best, base / best)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
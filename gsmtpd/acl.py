@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Access control by client address
+
+Example
+
+.. code:: python
+
+    acl = ACL(allow=['10.0.0.0/8', '2001:db8::/32'], deny=['10.1.2.0/24'])
+    '10.1.1.1' in acl   # True
+    '10.1.2.3' in acl   # False, the longest matching prefix wins
+
+The networks are kept in one binary prefix tree per address family, a
+lookup walks at most as many bits as the longest prefix it passes.
+:meth:`ACL.load` builds new trees and swaps them in at once, sessions
+looking up an address meanwhile see either the old or the new rules.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import binascii
+from gevent import socket
+
+__all__ = ['ACL']
+
+FAMILIES = ((socket.AF_INET, 32), (socket.AF_INET6, 128))
+MAPPED = '::ffff:'
+
+
+def parse(address):
+    """Return (family, number, bits) of an IP address"""
+    if address.lower().startswith(MAPPED) and '.' in address:
+        # IPv4 client of a dual-stack socket
+        address = address[len(MAPPED):]
+    for family, bits in FAMILIES:
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return family, int(binascii.hexlify(packed), 16), bits
+    raise ValueError('invalid IP address %r' % address)
+
+
+def parse_network(network):
+    """Return (family, prefix, prefix length) of an address or a CIDR"""
+    address, _, length = network.strip().partition('/')
+    family, number, bits = parse(address)
+    length = int(length) if length else bits
+    if not 0 <= length <= bits:
+        raise ValueError('invalid prefix length in %r' % network)
+    return family, number >> (bits - length), length
+
+
+class ACL(object):
+    """Allowed and denied networks, the longest matching prefix decides"""
+
+    def __init__(self, allow=(), deny=(), default=False, path=None):
+        """
+        :param allow: addresses or CIDR networks, IPv4 or IPv6
+        :param deny: addresses or CIDR networks
+        :param default: whether an address matching no network is allowed
+        :param path: file of rules loaded now and by :meth:`reload`, one\n
+                     `allow <network>` or `deny <network>` per line, a bare\n
+                     network is allowed, `#` starts a comment
+        """
+        self.default = default
+        self.path = path
+        self.trees = {}
+        self.size = 0
+        if path:
+            self.reload()
+        else:
+            self.load(allow, deny)
+
+    def __len__(self):
+        return self.size
+
+    def load(self, allow=(), deny=()):
+        """Replace all the rules"""
+        trees = dict((family, [None, None, None]) for family, _ in FAMILIES)
+        size = 0
+        for networks, allowed in ((allow, True), (deny, False)):
+            for network in networks:
+                family, prefix, length = parse_network(network)
+                node = trees[family]
+                for shift in xrange(length - 1, -1, -1):
+                    bit = (prefix >> shift) & 1
+                    if node[bit] is None:
+                        node[bit] = [None, None, None]
+                    node = node[bit]
+                node[2] = allowed
+                size += 1
+        self.trees = trees
+        self.size = size
+
+    def reload(self):
+        """Load the rules from `path` again"""
+        allow = []
+        deny = []
+        with open(self.path) as f:
+            for line in f:
+                words = line.split('#', 1)[0].split()
+                if not words:
+                    continue
+                if len(words) == 1:
+                    allow.append(words[0])
+                elif words[0] == 'allow':
+                    allow.append(words[1])
+                elif words[0] == 'deny':
+                    deny.append(words[1])
+                else:
+                    raise ValueError('invalid rule %r' % line)
+        self.load(allow, deny)
+        logger.info('Loaded %d rules from %s', self.size, self.path)
+
+    def lookup(self, address):
+        """Return True or False as the longest matching network says,
+        None if no network matches
+        """
+        family, number, bits = parse(address)
+        node = self.trees[family]
+        found = node[2]
+        for shift in xrange(bits - 1, -1, -1):
+            node = node[(number >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+    def __contains__(self, address):
+        try:
+            found = self.lookup(address)
+        except ValueError:
+            # not an IP address, e.g. an AF_UNIX peer
+            return self.default
+        return self.default if found is None else found
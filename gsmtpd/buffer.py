@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Receive buffer used by :class:`gsmtpd.channel.SMTPChannel`
+
+The socket reads straight into a preallocated ``bytearray`` and the channel
+gets ``memoryview`` slices of it, so incoming bytes are copied only once,
+by whoever decides to keep them.
+"""
+
+__all__ = ['ReceiveBuffer']
+
+
+class ReceiveBuffer(object):
+    """Preallocated receive buffer
+
+    Unconsumed bytes live between :attr:`start` and :attr:`end`.  Views
+    returned by :meth:`peek` and :meth:`take` are only valid until the next
+    :meth:`recv_into`, which may move the unconsumed bytes to the front.
+    """
+
+    def __init__(self, size=8192):
+        """
+        :param size: initial capacity in bytes, the buffer grows when a
+                     single unconsumed chunk does not fit and shrinks back
+                     once it has been drained
+        """
+        self.size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self.start = 0
+        self.end = 0
+        # everything before _scan has already been searched for _scanned
+        self._scan = 0
+        self._scanned = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    def recv_into(self, conn, size):
+        """Read at most `size` bytes from `conn` into the free tail
+
+        :returns: number of bytes read, 0 means the peer has closed
+        """
+        self._reserve(size)
+        n = conn.recv_into(self._view[self.end:self.end + size], size)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """Append `data` as if it had been received, mostly for tests"""
+        self._reserve(len(data))
+        self._view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def _reserve(self, size):
+        length = self.end - self.start
+        if length == 0 and size <= self.size < len(self._buf):
+            # drained after growing, go back to the initial capacity
+            self._resize(self.size, 0)
+        elif len(self._buf) - self.end >= size:
+            return
+        elif length + size <= len(self._buf):
+            # compact, the regions may overlap but memoryview copies safely
+            self._view[:length] = self._view[self.start:self.end]
+        else:
+            self._resize(max(len(self._buf) * 2, length + size), length)
+        self._scan = max(self._scan - self.start, 0)
+        self.start, self.end = 0, length
+
+    def _resize(self, size, length):
+        buf = bytearray(size)
+        if length:
+            buf[:length] = self._view[self.start:self.end]
+        # views handed out before keep the old buffer alive
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def consume(self, n):
+        """Drop `n` bytes from the head of the buffer"""
+        self.start += n
+        if self.start >= self.end:
+            self.start = self.end = self._scan = 0
+        elif self._scan < self.start:
+            self._scan = self.start
+
+    def peek(self, n=None):
+        """Return a view of the first `n` unconsumed bytes without consuming"""
+        if n is None:
+            return self._view[self.start:self.end]
+        return self._view[self.start:self.start + n]
+
+    def take(self, n=None):
+        """Return a view of the first `n` unconsumed bytes and consume them"""
+        view = self.peek(n)
+        self.consume(len(view))
+        return view
+
+    def clear(self):
+        self.start = self.end = self._scan = 0
+
+    def find(self, terminator):
+        """Find `terminator` in the unconsumed bytes
+
+        The search resumes where the previous unsuccessful search for the
+        same terminator stopped, so a line trickling in through many small
+        reads is not rescanned from its beginning every time.
+
+        :returns: offset relative to :attr:`start`, or -1
+        """
+        if terminator == self._scanned:
+            start = max(self._scan - len(terminator) + 1, self.start)
+        else:
+            start = self.start
+            self._scanned = terminator
+        index = self._buf.find(terminator, start, self.end)
+        if index < 0:
+            self._scan = self.end
+            return index
+        return index - self.start
+
+    def prefix_at_end(self, terminator):
+        """Same as :func:`asynchat.find_prefix_at_end` on the unconsumed bytes
+
+        :returns: length of the longest prefix of `terminator` that the
+                  buffer ends with
+        """
+        l = len(terminator) - 1
+        while l and not self._buf.endswith(terminator[:l], self.start, self.end):
+            l -= 1
+        return l
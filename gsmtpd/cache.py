@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cache of the results of :meth:`gsmtpd.server.SMTPServer.process_rcpt`
+
+An accepted address (the lookup returned None) is remembered for `ttl`
+seconds and a refused one for `negative_ttl` seconds, temporary failures
+(4xx replies) are not remembered.  Sessions asking for an address while
+its lookup is running wait for that lookup instead of starting another.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+from collections import OrderedDict
+
+from gevent.event import AsyncResult
+
+__all__ = ['RcptCache']
+
+
+class RcptCache(object):
+    """LRU cache with request coalescing in front of a lookup function"""
+
+    def __init__(self, lookup, size=10000, ttl=300, negative_ttl=60):
+        """
+        :param lookup: called with an address on a miss, returns None or\n
+                       an error reply like :meth:`process_rcpt`
+        :param size: max addresses remembered, the least recently used go first
+        :param ttl: seconds an accepted address is remembered
+        :param negative_ttl: seconds a refused address is remembered
+        """
+        self.lookup = lookup
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # address -> (expires, result), the most recently used at the end
+        self.entries = OrderedDict()
+        # address -> AsyncResult of the running lookup
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits,
+                    misses=self.misses, coalesced=self.coalesced,
+                    evictions=self.evictions)
+
+    def find(self, address):
+        """Return (True, result) of a cached address, (False, None) otherwise"""
+        entry = self.entries.pop(address, None)
+        if entry is not None and entry[0] > time.time():
+            self.entries[address] = entry
+            self.hits += 1
+            return True, entry[1]
+        return False, None
+
+    def get(self, address):
+        found, result = self.find(address)
+        if found:
+            return result
+        running = self.pending.get(address)
+        if running is not None:
+            self.coalesced += 1
+            return running.get()
+        self.misses += 1
+        running = self.pending[address] = AsyncResult()
+        try:
+            result = self.lookup(address)
+        except Exception as err:
+            running.set_exception(err)
+            raise
+        else:
+            self.put(address, result)
+            running.set(result)
+        finally:
+            self._release(address, running)
+        return result
+
+    def get_many(self, addresses, lookup):
+        """Like :meth:`get` for several addresses, the misses are looked
+        up with one call of `lookup`, which takes a list of addresses and
+        returns the list of their results, ValueError is raised if it
+        returns more or fewer
+        """
+        results = [None] * len(addresses)
+        waiting = []
+        missing = []
+        for index, address in enumerate(addresses):
+            found, result = self.find(address)
+            if found:
+                results[index] = result
+                continue
+            running = self.pending.get(address)
+            if running is not None:
+                self.coalesced += 1
+                waiting.append((index, running))
+                continue
+            self.misses += 1
+            running = self.pending[address] = AsyncResult()
+            missing.append((index, address, running))
+        if missing:
+            try:
+                found = lookup([address for _, address, _ in missing])
+                if len(found) != len(missing):
+                    raise ValueError('%d results for %d addresses' %
+                                     (len(found), len(missing)))
+            except Exception as err:
+                for _, address, running in missing:
+                    running.set_exception(err)
+                raise
+            else:
+                for (index, address, running), result in zip(missing, found):
+                    self.put(address, result)
+                    running.set(result)
+                    results[index] = result
+            finally:
+                for _, address, running in missing:
+                    self._release(address, running)
+        for index, running in waiting:
+            results[index] = running.get()
+        return results
+
+    def _release(self, address, running):
+        del self.pending[address]
+        if not running.ready():
+            # the lookup was killed, do not leave the waiters hanging
+            running.set_exception(LookupError('lookup of %s interrupted' %
+                                              address))
+
+    def put(self, address, result):
+        """Remember the result of a lookup done elsewhere"""
+        if result is None:
+            ttl = self.ttl
+        elif result[:1] == '4':
+            return
+        else:
+            ttl = self.negative_ttl
+        self.entries.pop(address, None)
+        self.entries[address] = (time.time() + ttl, result)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, address=None):
+        """Forget an address, or all of them"""
+        if address is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(address, None)
@@ -3,12 +3,18 @@
 
 import logging
 logger = logging.getLogger(__name__)
-from gevent import monkey, socket, ssl
+import gevent
+from gevent import monkey, socket
 
 import errno
-from asynchat import find_prefix_at_end
+import time
+
+from .buffer import ReceiveBuffer
+from .timer import ConnectionTimeout
+from .transcode import Unstuffer
 
 NEWLINE = '\n'
+CRLF = '\r\n'
 EMPTYSTRING = ''
 COMMASPACE = ', '
 
@@ -18,11 +24,59 @@ monkey.patch_all()
 class SMTPChannel(object):
     """
     Port from stdlib smtpd used by Gevent
+
+    Commands are dispatched to the `smtp_<COMMAND>` methods through a table
+    built once per class, a subclass overriding or adding such a method or
+    calling :meth:`register_command` gets its own table.
     """
     COMMAND = 0
     DATA = 1
+    BDAT = 2
+
+    # RFC 5321, Section 4.5.3.1.4, including <CRLF>
+    max_line_length = 512
+    # commands allowed longer lines, RFC 1870 adds 26 octets to MAIL
+    # when SIZE is advertised
+    line_lengths = {'MAIL': 512 + 26}
+    # methods that are not commands a client may send
+    internal_commands = ('TIMEOUT',)
+
+    @classmethod
+    def register_command(cls, name, handler):
+        """Add or replace a command of this class and its subclasses
+
+        :param name: command verb, like `XCLIENT`
+        :param handler: function called as `handler(channel, arg)`, `arg`\n
+                        is None when the command has no argument
+        """
+        if '_extensions' not in cls.__dict__:
+            cls._extensions = {}
+        cls._extensions[name.upper()] = handler
+        classes = [cls]
+        while classes:
+            klass = classes.pop()
+            klass._commands = None
+            classes.extend(klass.__subclasses__())
 
-    def __init__(self, server, conn, addr, data_size_limit=1024000):
+    @classmethod
+    def commands(cls):
+        """Return the dispatch table of the class, command -> function"""
+        table = cls.__dict__.get('_commands')
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                if name.startswith('smtp_'):
+                    table[name[5:]] = getattr(cls, name).__func__
+            for klass in reversed(cls.__mro__):
+                table.update(klass.__dict__.get('_extensions', {}))
+            for name in cls.internal_commands:
+                table.pop(name, None)
+            cls._commands = table
+        return table
+
+    def __init__(self, server, conn, addr, data_size_limit=1024000, tls=False):
+        self.started = time.time()
+        self.metrics = metrics = server.metrics
         self.server = server
         self.conn = conn
         self.addr = addr
@@ -32,14 +86,48 @@ class SMTPChannel(object):
         self.mailfrom = None
         self.rcpttos = []
         self.data = ''
-        self.fqdn = socket.getfqdn()
+        self.binarymime = False
+        self.message = None
+        self.chunk_size = 0
+        self.chunk_error = None
+        self.last_chunk = False
+        self.unstuffer = None
+        self.fqdn = server.fqdn
         self.ac_in_buffer_size = 4096
+        self.dispatch = self.commands()
+        self.line_size = 0
+        # longest line collected, the limit of each command is checked once
+        # the command is known
+        self.line_limit = max([self.max_line_length] +
+                              self.line_lengths.values())
+        # command whose replies are being pushed, for the metrics
+        self.command = 'CONNECT'
+        self.message_started = None
+        # bytes read from and sent to the client
+        self.received = 0
+        self.sent = 0
+        self.debug = logger.isEnabledFor(logging.DEBUG)
 
-        self.ac_in_buffer = ''
+        self.ac_in_buffer = ReceiveBuffer(self.ac_in_buffer_size * 2)
+        # replies wait here until the input at hand has been processed
+        self.ac_out_buffer = []
+        # (index in ac_out_buffer, address) of the RCPT not answered yet
+        self.pending_rcpts = []
         self.closed = False
+        # time of a close during a timed command, see close_when_done()
+        self.dispatching = False
+        self.closed_at = None
         self.data_size_limit = data_size_limit # in byte
         self.current_size = 0
         self.tls = False
+        # deadline of the current read or write, see arm()
+        self.greenlet = gevent.getcurrent()
+        self.deadline = None
+        self.timer_slot = None
+        self.message_deadline = None
+        self.session_deadline = None
+        if server.session_timeout:
+            self.session_deadline = time.time() + server.session_timeout
         try:
             self.peer = conn.getpeername()
         except socket.error as err:
@@ -50,71 +138,247 @@ class SMTPChannel(object):
             if err[0] != errno.ENOTCONN:
                 raise
             return
+        if server.on_connect is not None:
+            server.on_connect(self, self.started)
+        if tls:
+            # implicit TLS, the handshake comes before the banner
+            try:
+                self.arm()
+                self.conn = server.wrap_ssl(conn)
+                self.deadline = None
+                self.tls = True
+                if metrics is not None:
+                    metrics.tls.inc(('implicit',))
+            except socket.error as err:
+                logger.debug('%s:%s TLS handshake failed, %s',
+                             addr[0], addr[1], err)
+                self.close_when_done()
+                return
+            except ConnectionTimeout:
+                # no banner to answer with 421, just close
+                logger.warn('%s:%s TLS handshake timeouted', *addr[:2])
+                if metrics is not None:
+                    metrics.timeouts.inc()
+                self.close_when_done()
+                return
         self.push('220 %s GSMTPD at your service' % self.fqdn)
+        self.flush()
+        if metrics is not None:
+            metrics.banner.observe(time.time() - self.started)
         self.terminator = '\r\n'
         logger.debug('SMTP channel initialized')
 
     # Overrides base class for convenience
     def push(self, msg):
-        logger.debug('PUSH %s' % msg)
-        self.conn.send(msg + '\r\n')
+        if self.debug:
+            logger.debug('PUSH %s', msg)
+        if self.metrics is not None:
+            self.metrics.replies.inc((self.command, msg[:1] + 'xx'))
+        self.ac_out_buffer.append(msg)
+
+    def flush(self):
+        """Send all pushed replies with a single sendall"""
+        if self.pending_rcpts:
+            self.resolve_rcpts()
+        if not self.ac_out_buffer:
+            return
+        data = CRLF.join(self.ac_out_buffer) + CRLF
+        self.ac_out_buffer = []
+        deadline = self.deadline
+        self.arm()
+        try:
+            self.conn.sendall(data)
+        except socket.error:
+            self.handle_error()
+        else:
+            self.sent += len(data)
+            if self.metrics is not None:
+                self.metrics.bytes.inc(('out',), len(data))
+        finally:
+            self.deadline = deadline
+
+    def arm(self):
+        """Set the deadline of the client for the current phase"""
+        server = self.server
+        if self.state != self.COMMAND:
+            timeout = server.data_block_timeout
+        elif self.seen_greeting:
+            timeout = server.timeout
+        else:
+            timeout = server.greeting_timeout
+        deadline = time.time() + timeout
+        if self.message_deadline is not None and self.message is not None:
+            deadline = min(deadline, self.message_deadline)
+        if self.session_deadline is not None:
+            deadline = min(deadline, self.session_deadline)
+        self.deadline = deadline
+        server.timers.schedule(self)
+
+    def expire(self):
+        # called by the timer wheel of the server once the deadline passed
+        if not self.closed:
+            gevent.kill(self.greenlet, ConnectionTimeout)
 
     # Implementation of base class abstract method
     def collect_incoming_data(self, data):
-        self.line.append(data)
+        if self.state == self.BDAT:
+            # the size was checked by smtp_BDAT, a failed chunk is dropped
+            if self.message is not None and not self.chunk_error:
+                self.collect_message_data(data.tobytes())
+            return
         self.current_size += len(data)
         if self.current_size > self.data_size_limit:
             self.push('452 Command has been aborted because mail too big')
             self.close_when_done()
+            return
+        # data is a view into the receive buffer, keep a copy
+        if self.state == self.DATA:
+            self.collect_message_data(data.tobytes())
+            return
+        self.line_size += len(data)
+        if self.line_size <= self.line_limit - 2:
+            self.line.append(data.tobytes())
+        elif self.line:
+            # the rest of the line is dropped until its end
+            self.line = []
+
+    def collect_message_data(self, data):
+        # Remove extraneous carriage returns and de-transparency according
+        # to RFC 821, Section 4.5.2. BINARYMIME is passed on untouched.
+        if self.unstuffer is not None:
+            data = self.unstuffer.feed(data)
+        if data:
+            self.server.process_message_chunk(self.message, data)
 
     # Implementation of base class abstract method
     def found_terminator(self):
         line = EMPTYSTRING.join(self.line)
         self.line = []
         if self.state == self.COMMAND:
+            size, self.line_size = self.line_size, 0
+            if size > self.line_limit - 2:
+                if self.pending_rcpts:
+                    self.resolve_rcpts()
+                self.command = 'UNKNOWN'
+                self.push('500 Error: line too long')
+                return
             if not line:
+                self.command = 'UNKNOWN'
                 self.push('500 Error: bad syntax')
                 return
-            method = None
-            i = line.find(' ')
-            if i < 0:
-                command = line.upper().strip()
+            parts = line.split(' ', 1)
+            command = parts[0]
+            if len(parts) == 1:
                 arg = None
+                command = command.strip()
             else:
-                command = line[:i].upper()
-                arg = line[i+1:].strip()
-            method = getattr(self, 'smtp_' + command, None)
-            logger.debug('%s:%s', command, arg)
-            if not method:
+                arg = parts[1].strip()
+            handler = self.dispatch.get(command)
+            if handler is None:
+                command = command.upper()
+                handler = self.dispatch.get(command)
+            if self.pending_rcpts and command != 'RCPT':
+                self.resolve_rcpts()
+            if (size > self.max_line_length - 2 and size >
+                    self.line_lengths.get(command, self.max_line_length) - 2):
+                self.command = 'UNKNOWN'
+                self.push('500 Error: line too long')
+                return
+            if self.debug:
+                logger.debug('%s:%s', command, arg)
+            if handler is None:
+                # any verb would make a new label
+                self.command = 'UNKNOWN'
                 self.push('502 Error: command "%s" not implemented' % command)
                 return
-            method(arg)
-            return
-        else:
-            if self.state != self.DATA:
-                self.push('451 Internal confusion')
+            self.command = command
+            hook = self.server.on_command
+            if self.metrics is None and hook is None:
+                handler(self, arg)
                 return
-            # Remove extraneous carriage returns and de-transparency according
-            # to RFC 821, Section 4.5.2.
-            data = []
-            for text in line.split('\r\n'):
-                if text and text[0] == '.':
-                    data.append(text[1:])
-                else:
-                    data.append(text)
-            self.data = NEWLINE.join(data)
-            status = self.server.process_message(self.peer,
-                                                   self.mailfrom,
-                                                   self.rcpttos,
-                                                   self.data)
-            self.rcpttos = []
-            self.mailfrom = None
+            started = time.time()
+            self.dispatching = True
+            try:
+                handler(self, arg)
+                duration = time.time() - started
+                if self.metrics is not None:
+                    self.metrics.commands.observe(duration, (command,))
+                if hook is not None:
+                    hook(self, command, arg, started, duration)
+            finally:
+                self.dispatching = False
+                if self.closed_at is not None:
+                    self.server.on_close(self, self.closed_at)
+            return
+        elif self.state == self.DATA:
             self.state = self.COMMAND
             self.terminator = '\r\n'
-            if not status:
-                self.push('250 Ok')
-            else:
-                self.push(status)
+            self.finish_message()
+        elif self.state == self.BDAT:
+            self.state = self.COMMAND
+            self.terminator = '\r\n'
+            self.found_chunk()
+        else:
+            self.push('451 Internal confusion')
+
+    def found_chunk(self):
+        if self.chunk_error:
+            error, self.chunk_error = self.chunk_error, None
+            self.push(error)
+        elif self.last_chunk:
+            self.finish_message()
+        else:
+            self.push('250 Ok: %d octets received' % self.chunk_size)
+
+    def finish_message(self):
+        if self.unstuffer is not None:
+            data = self.unstuffer.flush()
+            if data:
+                self.server.process_message_chunk(self.message, data)
+        message, self.message = self.message, None
+        server = self.server
+        metrics = self.metrics
+        if (metrics is None and server.on_data_end is None and
+                server.on_message_processed is None):
+            status = server.process_message_end(message)
+        else:
+            started = time.time()
+            if metrics is not None:
+                metrics.data.observe(started - self.message_started)
+            if server.on_data_end is not None:
+                server.on_data_end(self, started, self.current_size)
+            status = server.process_message_end(message)
+            duration = time.time() - started
+            if metrics is not None:
+                metrics.processing.observe(duration)
+            if server.on_message_processed is not None:
+                server.on_message_processed(self, started, duration, status)
+        self.rcpttos = []
+        self.mailfrom = None
+        self.binarymime = False
+        if not status:
+            self.push('250 Ok')
+        else:
+            self.push(status)
+
+    def start_message(self, unstuffer):
+        if self.server.data_timeout:
+            self.message_deadline = time.time() + self.server.data_timeout
+        self.current_size = 0
+        self.unstuffer = unstuffer
+        server = self.server
+        if self.metrics is not None or server.on_data_start is not None:
+            self.message_started = time.time()
+            if server.on_data_start is not None:
+                server.on_data_start(self, self.message_started)
+        self.message = self.server.process_message_start(self.peer,
+                                                         self.mailfrom,
+                                                         self.rcpttos)
+
+    def abort_message(self):
+        if self.message is not None:
+            message, self.message = self.message, None
+            self.server.process_message_abort(message)
     
     # SMTP and ESMTP commands
     def smtp_HELO(self, arg):
@@ -149,6 +413,9 @@ class SMTPChannel(object):
 
             if self.data_size_limit:
                 self.push('250-SIZE %s' % self.data_size_limit)
+            self.push('250-PIPELINING')
+            self.push('250-CHUNKING')
+            self.push('250-BINARYMIME')
             self.push('250 HELP')
     
     def smtp_NOOP(self, arg):
@@ -163,6 +430,7 @@ class SMTPChannel(object):
         self.close_when_done()
 
     def smtp_TIMEOUT(self, arg=""):
+        self.command = 'TIMEOUT'
         self.push('421 2.0.0 Bye')
         self.close_when_done()
 
@@ -189,6 +457,7 @@ class SMTPChannel(object):
             self.push('503 Error: nested MAIL command')
             return
         self.mailfrom = address
+        self.binarymime = 'BODY=BINARYMIME' in arg.upper()
         self.push('250 Ok')
 
     def smtp_RCPT(self, arg):
@@ -199,19 +468,45 @@ class SMTPChannel(object):
         if not address:
             self.push('501 Syntax: RCPT TO: <address>')
             return
-        
-        result = self.server.process_rcpt(address)
-        if not result:
-            self.rcpttos.append(address)
-            self.push('250 Ok')
-        else:
-            self.push(result)
+
+        # answered by resolve_rcpts() together with the RCPT commands
+        # pipelined after this one, the reply keeps its place meanwhile
+        self.pending_rcpts.append((len(self.ac_out_buffer), address))
+        self.ac_out_buffer.append(None)
+
+    def resolve_rcpts(self):
+        """Validate the pending recipients with one call to the server"""
+        pending, self.pending_rcpts = self.pending_rcpts, []
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+        try:
+            results = self.server.lookup_rcpts([address for _, address
+                                                in pending])
+        except Exception as err:
+            # every RCPT has its reply slot waiting, none may be accepted
+            logger.error(err, exc_info=True)
+            results = ['451 Requested action aborted: local error in '
+                       'processing'] * len(pending)
+        if metrics is not None:
+            metrics.rcpt_lookups.observe(time.time() - started)
+        for (index, address), result in zip(pending, results):
+            if not result:
+                self.rcpttos.append(address)
+                result = '250 Ok'
+            if self.debug:
+                logger.debug('PUSH %s', result)
+            if metrics is not None:
+                metrics.replies.inc(('RCPT', result[:1] + 'xx'))
+            self.ac_out_buffer[index] = result
 
     def smtp_RSET(self, arg):
         if arg:
             self.push('501 Syntax: RSET')
             return
         # Resets the sender, recipients, and data, but not the greeting
+        self.abort_message()
+        self.binarymime = False
         self.mailfrom = None
         self.rcpttos = []
         self.data = ''
@@ -225,9 +520,46 @@ class SMTPChannel(object):
         if arg:
             self.push('501 Syntax: DATA')
             return
+        if self.binarymime or self.message is not None:
+            self.push('503 Error: message must be sent with BDAT')
+            return
         self.state = self.DATA
         self.terminator = '\r\n.\r\n'
+        self.start_message(Unstuffer())
         self.push('354 End data with <CR><LF>.<CR><LF>')
+        # DATA ends a pipelined group (RFC 2920), the client waits for 354
+        self.flush()
+
+    def smtp_BDAT(self, arg):
+        # RFC 3030, the chunk follows the command line and is counted by the
+        # numeric terminator instead of being scanned for <CR><LF>.<CR><LF>
+        args = arg.split() if arg else []
+        if (not 1 <= len(args) <= 2 or not args[0].isdigit() or
+                args[1:] and args[1].upper() != 'LAST'):
+            self.push('501 Syntax: BDAT chunk-size [LAST]')
+            return
+        self.chunk_size = int(args[0])
+        self.last_chunk = len(args) == 2
+
+        if not self.rcpttos:
+            self.chunk_error = '503 Error: need RCPT command'
+        else:
+            if self.message is None:
+                self.start_message(None if self.binarymime else
+                                   Unstuffer(dots=False))
+            self.current_size += self.chunk_size
+            if self.current_size > self.data_size_limit:
+                # the transaction is over, the following chunks get a 503
+                self.abort_message()
+                self.mailfrom = None
+                self.rcpttos = []
+                self.current_size = 0
+                self.chunk_error = '552 Error: message too big'
+
+        self.state = self.BDAT
+        self.terminator = self.chunk_size
+        if not self.chunk_size:
+            self.found_terminator()
 
     def smtp_STARTTLS(self, arg):
 
@@ -240,13 +572,29 @@ class SMTPChannel(object):
             self.push('500 Too late to changed')
             return
 
+        self.flush()
+        # Anything pipelined after STARTTLS came in plain text, it must not
+        # be taken as sent over TLS
+        self.ac_in_buffer.clear()
         try:
-            self.conn = ssl.wrap_socket(self.conn, **self.server.ssl)
+            self.arm()
+            self.conn = self.server.wrap_ssl(self.conn)
+            self.deadline = None
+            self.abort_message()
+            self.binarymime = False
             self.state = self.COMMAND
             self.seen_greeting = 0
             self.rcpttos = []
             self.mailfrom = None
             self.tls = True
+            if self.metrics is not None:
+                self.metrics.tls.inc(('starttls',))
+        except ConnectionTimeout:
+            # no reply in the middle of the handshake, just close
+            logger.warn('%s:%s TLS handshake timeouted', *self.addr[:2])
+            if self.metrics is not None:
+                self.metrics.timeouts.inc()
+            self.close_when_done()
         except Exception as err:
             logger.error(err, exc_info=True)
             self.push('503 certificate is FAILED')
@@ -263,39 +611,44 @@ class SMTPChannel(object):
             self.push('214 SMTP server is running...go to website for further help')
 
     def handle_read(self):
+        buf = self.ac_in_buffer
+        self.arm()
         try:
-            data = self.conn.recv(self.ac_in_buffer_size)
-            if len(data) == 0:
-                # issues 2 TCP connect closed will send a 0 size pack
-                self.close_when_done()
+            n = buf.recv_into(self.conn, self.ac_in_buffer_size)
         except socket.error:
             self.handle_error()
             return
-
-        self.ac_in_buffer = self.ac_in_buffer + data
+        # the timer only checks every now and then, a late client may have
+        # made it before the wheel came round
+        if time.time() > self.deadline:
+            raise ConnectionTimeout()
+        self.received += n
+        if self.metrics is not None:
+            self.metrics.bytes.inc(('in',), n)
+        # no deadline while the server is busy with what was read
+        self.deadline = None
+        if n == 0:
+            # issues 2 TCP connect closed will send a 0 size pack
+            self.close_when_done()
 
         # Continue to search for self.terminator in self.ac_in_buffer,
         # while calling self.collect_incoming_data.  The while loop
         # is necessary because we might read several data+terminator
         # combos with a single recv(4096).
 
-        while self.ac_in_buffer:
-            lb = len(self.ac_in_buffer)
-            logger.debug(self.ac_in_buffer)
-            if not self.terminator:
+        while buf and not self.closed:
+            terminator = self.terminator
+            if not terminator:
                 # no terminator, collect it all
-                self.collect_incoming_data(self.ac_in_buffer)
-                self.ac_in_buffer = ''
-            elif isinstance(self.terminator, int) or isinstance(self.terminator, long):
+                self.collect_incoming_data(buf.take())
+            elif isinstance(terminator, (int, long)):
                 # numeric terminator
-                n = self.terminator
-                if lb < n:
-                    self.collect_incoming_data(self.ac_in_buffer)
-                    self.ac_in_buffer = ''
-                    self.terminator = self.terminator - lb
+                lb = len(buf)
+                if lb < terminator:
+                    self.collect_incoming_data(buf.take())
+                    self.terminator = terminator - lb
                 else:
-                    self.collect_incoming_data (self.ac_in_buffer[:n])
-                    self.ac_in_buffer = self.ac_in_buffer[n:]
+                    self.collect_incoming_data(buf.take(terminator))
                     self.terminator = 0
                     self.found_terminator()
             else:
@@ -306,36 +659,48 @@ class SMTPChannel(object):
                 #    collect data to the prefix
                 # 3) end of buffer does not match any prefix:
                 #    collect data
-                terminator_len = len(self.terminator)
-                index = self.ac_in_buffer.find(self.terminator)
+                index = buf.find(terminator)
                 if index != -1:
                     # we found the terminator
                     if index > 0:
                         # don't bother reporting the empty string (source of subtle bugs)
-                        self.collect_incoming_data (self.ac_in_buffer[:index])
-                    self.ac_in_buffer = self.ac_in_buffer[index+terminator_len:]
+                        self.collect_incoming_data(buf.take(index))
+                    buf.consume(len(terminator))
                     # This does the Right Thing if the terminator is changed here.
                     self.found_terminator()
                 else:
                     # check for a prefix of the terminator
-                    index = find_prefix_at_end(self.ac_in_buffer, self.terminator)
+                    index = buf.prefix_at_end(terminator)
                     if index:
+                        lb = len(buf)
                         if index != lb:
                             # we found a prefix, collect up to the prefix
-                            self.collect_incoming_data (self.ac_in_buffer[:-index])
-                            self.ac_in_buffer = self.ac_in_buffer[-index:]
+                            self.collect_incoming_data(buf.take(lb - index))
                         break
                     else:
                         # no prefix, collect it all
-                        self.collect_incoming_data(self.ac_in_buffer)
-                        self.ac_in_buffer = ''
-        
+                        self.collect_incoming_data(buf.take())
+
+        self.flush()
+
     def handle_error(self):
         self.close_when_done()
 
     def close_when_done(self):
 
+        self.abort_message()
+
         if not self.conn.closed:
+            self.flush()
             logger.debug('CLOSED %s' % self.conn)
             self.conn.close()
+        # after the flush, which arms the write deadline again
+        self.deadline = None
+        self.server.timers.cancel(self)
+        if not self.closed and self.server.on_close is not None:
+            if self.dispatching:
+                # QUIT and the like, on_close follows their on_command
+                self.closed_at = time.time()
+            else:
+                self.server.on_close(self, time.time())
         self.closed = True
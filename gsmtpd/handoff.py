@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Queue between the SMTP sessions and the code that processes the messages
+
+With a :class:`MessageQueue` a session replies `250` as soon as the
+message is queued and goes on reading the next command, a pool of worker
+greenlets (or threads) calls the handler in the background.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+import gevent
+from gevent.queue import Queue, Full
+
+__all__ = ['MessageQueue']
+
+_STOP = object()
+
+
+class MessageQueue(object):
+    """Bounded queue of messages consumed by a pool of workers"""
+
+    def __init__(self, handler, maxsize=1000, workers=10, threads=False,
+                 done=None):
+        """
+        :param handler: called with every message put into the queue
+        :param maxsize: max number of messages waiting
+        :param workers: number of workers calling `handler`
+        :param threads: call `handler` in the threadpool of the gevent hub,\n
+                        for handlers that block without cooperating with gevent
+        :param done: called in the worker greenlet with every message\n
+                     once `handler` returned or raised
+        """
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.threads = threads
+        self.done = done
+        self.queue = Queue(maxsize)
+        self.pool = []
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        # moving average of the seconds a message waits for a worker
+        self.latency = 0.0
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def start(self):
+        while len(self.pool) < self.workers:
+            self.pool.append(gevent.spawn(self._work))
+
+    def stop(self, timeout=None):
+        """Let the workers finish the queued messages, at most `timeout` seconds
+
+        Call it once nothing puts messages anymore, every worker gets a stop
+        sentinel behind the queued messages.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        remaining = lambda: None if deadline is None else max(deadline - time.time(), 0)
+        try:
+            for _ in self.pool:
+                # waits for room while the workers drain a full queue
+                self.queue.put(_STOP, timeout=remaining())
+        except Full:
+            pass
+        gevent.joinall(self.pool, timeout=remaining())
+        gevent.killall(self.pool, block=False)
+        self.pool = []
+
+    def put(self, message, timeout=None):
+        """Queue `message`, waiting at most `timeout` seconds for room
+
+        :returns: False if the queue stayed full
+        """
+        try:
+            self.queue.put((message, time.time()), timeout=timeout)
+        except Full:
+            return False
+        return True
+
+    def stats(self):
+        return dict(queued=len(self), busy=self.busy,
+                    processed=self.processed, failed=self.failed,
+                    latency=self.latency)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            message, queued_at = item
+            self.latency = self.latency * 0.9 + (time.time() - queued_at) * 0.1
+            self.busy += 1
+            try:
+                if self.threads:
+                    gevent.get_hub().threadpool.apply(self.handler, (message,))
+                else:
+                    self.handler(message)
+                self.processed += 1
+            except Exception as err:
+                self.failed += 1
+                logger.error(err, exc_info=True)
+            finally:
+                self.busy -= 1
+            if self.done is not None:
+                try:
+                    self.done(message)
+                except Exception as err:
+                    logger.error(err, exc_info=True)
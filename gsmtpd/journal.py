@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Durable spool of the accepted messages
+
+:class:`Journal` appends every message to a segment file and returns once
+the record is on disk.  The fsync is shared: a committer greenlet syncs the
+segment every `commit_window` seconds for all the records appended in the
+meantime, so many sessions pay for one fsync.  Once a message has been
+processed an acknowledgement record is appended, on the next start the
+messages without one are found by :meth:`Journal.recover` and their data
+read back one at a time by :meth:`Journal.read`.
+
+Record layout::
+
+    crc32 kind id envelope-length data-length | envelope | data
+
+the crc32 covers everything after itself, a torn record at the end of a
+segment (a crash during a write) ends the scan of that segment.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import os
+import struct
+import zlib
+
+import gevent
+from gevent.event import AsyncResult
+
+__all__ = ['Journal']
+
+HEADER = struct.Struct('!IBQII')
+MESSAGE = 1
+ACK = 2
+SUFFIX = '.journal'
+# bytes of message data checked at a time by the recovery
+CHUNK = 64 * 1024
+
+
+def _crc(header, envelope, data):
+    crc = zlib.crc32(header[4:])
+    crc = zlib.crc32(envelope, crc)
+    crc = zlib.crc32(data, crc)
+    return crc & 0xffffffff
+
+
+class Segment(object):
+    """One journal file and the ids of its unacknowledged messages"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = set()
+        self.file = None
+        self.size = 0
+
+
+class Journal(object):
+    """Append-only segmented journal with group-commit fsync"""
+
+    def __init__(self, directory, commit_window=0,
+                 segment_size=64 * 1024 * 1024):
+        """
+        :param directory: directory of the segment files, created if missing
+        :param commit_window: seconds appended records wait to be synced together,\n
+                              0 syncs as soon as the committer gets to run, what\n
+                              is appended during an fsync shares the next one
+        :param segment_size: bytes after which a new segment is started
+        """
+        self.directory = directory
+        self.commit_window = commit_window
+        self.segment_size = segment_size
+        self.segments = []
+        # message id -> segment
+        self.entries = {}
+        # message id -> (path, offset, length) of the recovered data
+        self.recovered = {}
+        self.next_id = 1
+        self.current = None
+        # segments written to since the last fsync
+        self._dirty = []
+        self._batch = None
+        self._committer = None
+        self.commits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, '%016d%s' % (number, SUFFIX))
+
+    def _scan(self, path):
+        """Yield (kind, id, envelope, offset, length) of the valid records
+        in `path`, the data is checked but not kept
+        """
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                crc, kind, entry, envlen, datalen = HEADER.unpack(header)
+                envelope = f.read(envlen)
+                offset = f.tell()
+                check = zlib.crc32(envelope, zlib.crc32(header[4:]))
+                left = datalen
+                while left:
+                    chunk = f.read(min(left, CHUNK))
+                    if not chunk:
+                        break
+                    check = zlib.crc32(chunk, check)
+                    left -= len(chunk)
+                if (len(envelope) < envlen or left or
+                        check & 0xffffffff != crc):
+                    logger.warn('Torn record in %s, ignoring the rest', path)
+                    return
+                yield kind, entry, envelope, offset, datalen
+
+    def recover(self):
+        """Open the journal
+
+        Only the envelopes are kept, the data of a message is read by
+        :meth:`read` when it is needed.
+
+        :returns: list of (id, peer, mailfrom, rcpttos) of the messages\n
+                  never acknowledged, in the order they were accepted
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SUFFIX))
+        found = {}
+        number = 0
+        for name in names:
+            number = int(name[:-len(SUFFIX)])
+            segment = Segment(os.path.join(self.directory, name))
+            self.segments.append(segment)
+            for kind, entry, envelope, offset, length in \
+                    self._scan(segment.path):
+                self.next_id = max(self.next_id, entry + 1)
+                if kind == MESSAGE:
+                    found[entry] = (segment, envelope, offset, length)
+                    segment.pending.add(entry)
+                elif kind == ACK and entry in found:
+                    found.pop(entry)[0].pending.discard(entry)
+        pending = []
+        for entry in sorted(found):
+            segment, envelope, offset, length = found[entry]
+            self.entries[entry] = segment
+            self.recovered[entry] = (segment.path, offset, length)
+            peer, mailfrom, rcpttos = json.loads(envelope)
+            pending.append((entry, tuple(peer), mailfrom, rcpttos))
+        self._open_segment(number + 1)
+        self._collect()
+        if pending:
+            logger.info('Recovered %d messages from %s',
+                        len(pending), self.directory)
+        return pending
+
+    def read(self, entry):
+        """Return the data of a message returned by :meth:`recover`"""
+        path, offset, length = self.recovered.pop(entry)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _open_segment(self, number):
+        segment = Segment(self._segment_path(number))
+        segment.file = open(segment.path, 'ab')
+        self.segments.append(segment)
+        self.current = segment
+
+    def _write(self, kind, entry, envelope='', data=''):
+        header = HEADER.pack(0, kind, entry, len(envelope), len(data))
+        header = HEADER.pack(_crc(header, envelope, data), kind, entry,
+                             len(envelope), len(data))
+        segment = self.current
+        segment.file.write(header)
+        segment.file.write(envelope)
+        segment.file.write(data)
+        segment.size += len(header) + len(envelope) + len(data)
+        if segment not in self._dirty:
+            self._dirty.append(segment)
+        if segment.size >= self.segment_size:
+            number = int(os.path.basename(segment.path)[:-len(SUFFIX)])
+            self._open_segment(number + 1)
+        return segment
+
+    def append(self, peer, mailfrom, rcpttos, data):
+        """Write a message and wait until it is on disk
+
+        :param data: message text, a string or a buffer like :class:`mmap.mmap`
+        :returns: id of the message to pass to :meth:`ack`
+        """
+        entry = self.next_id
+        self.next_id += 1
+        envelope = json.dumps([list(peer), mailfrom, rcpttos])
+        segment = self._write(MESSAGE, entry, envelope, data)
+        segment.pending.add(entry)
+        self.entries[entry] = segment
+        self.sync()
+        return entry
+
+    def ack(self, entry):
+        """Mark a message as processed, it will not be recovered again
+
+        The acknowledgement is synced with the next batch, a crash before
+        that only means the message is processed twice.
+        """
+        self.recovered.pop(entry, None)
+        segment = self.entries.pop(entry, None)
+        if segment is None:
+            return
+        segment.pending.discard(entry)
+        self._write(ACK, entry)
+        self._collect()
+
+    def sync(self):
+        """Wait for the next group commit"""
+        if self._batch is None:
+            self._batch = AsyncResult()
+        batch = self._batch
+        if self._committer is None:
+            self._committer = gevent.spawn(self._commit)
+        batch.get()
+
+    def _commit(self):
+        try:
+            while self._batch is not None:
+                if self.commit_window:
+                    gevent.sleep(self.commit_window)
+                batch, self._batch = self._batch, None
+                dirty, self._dirty = self._dirty, []
+                try:
+                    for segment in dirty:
+                        if segment.file is None:
+                            continue
+                        segment.file.flush()
+                        gevent.get_hub().threadpool.apply(
+                            os.fsync, (segment.file.fileno(),))
+                except Exception as err:
+                    logger.error(err, exc_info=True)
+                    batch.set_exception(err)
+                else:
+                    self.commits += 1
+                    batch.set()
+                for segment in dirty:
+                    if segment is not self.current and segment.file is not None:
+                        segment.file.close()
+                        segment.file = None
+                self._collect()
+        finally:
+            self._committer = None
+
+    def _collect(self):
+        """Remove the oldest segments once all their messages are acknowledged
+
+        Going from the oldest keeps every acknowledgement at least as long
+        as the message it refers to.
+        """
+        while self.segments:
+            segment = self.segments[0]
+            if (segment is self.current or segment.pending or
+                    segment.file is not None or segment in self._dirty):
+                return
+            self.segments.pop(0)
+            try:
+                os.unlink(segment.path)
+            except OSError as err:
+                logger.error(err)
+
+    def close(self):
+        if self._committer is not None:
+            self._committer.join()
+        for segment in self.segments:
+            if segment.file is not None:
+                segment.file.flush()
+                os.fsync(segment.file.fileno())
+                segment.file.close()
+                segment.file = None
+        self._dirty = []
+        self.current = None
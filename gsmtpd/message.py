@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Message objects handed around by the streaming API of
+:class:`gsmtpd.server.SMTPServer`
+"""
+
+import mmap
+import tempfile
+
+__all__ = ['MessageBuffer']
+
+EMPTYSTRING = ''
+
+
+class MessageBuffer(object):
+    """Collects the chunks of one message
+
+    This is what :meth:`gsmtpd.server.SMTPServer.process_message_start`
+    returns by default, the whole message is handed to
+    :meth:`gsmtpd.server.SMTPServer.process_message` at the end.
+
+    With a `spool_threshold` the message is kept in memory only up to that
+    many bytes, then it is spilled to an anonymous temporary file and
+    :meth:`getvalue` returns a read-only :class:`mmap.mmap` of it.
+    """
+
+    def __init__(self, peer, mailfrom, rcpttos,
+                 spool_threshold=None, spool_dir=None):
+        """
+        :param spool_threshold: bytes kept in memory before spilling to disk,
+                                None keeps everything in memory
+        :param spool_dir: directory of the temporary files, see
+                          :func:`tempfile.TemporaryFile`
+        """
+        self.peer = peer
+        self.mailfrom = mailfrom
+        self.rcpttos = rcpttos
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.size = 0
+        self.chunks = []
+        self.file = None
+        self.map = None
+        # id in the journal of the server, see gsmtpd.journal
+        self.journal_id = None
+
+    @property
+    def spooled(self):
+        return self.file is not None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.chunks.append(data)
+        if self.spool_threshold is not None and self.size > self.spool_threshold:
+            self.file = tempfile.TemporaryFile(prefix='gsmtpd-',
+                                               dir=self.spool_dir)
+            self.file.writelines(self.chunks)
+            self.chunks = []
+
+    def getvalue(self):
+        """Return the message as a string, or as a read-only
+        :class:`mmap.mmap` once it has been spooled to disk
+        """
+        if self.file is None:
+            return EMPTYSTRING.join(self.chunks)
+        if self.map is None:
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        self.chunks = []
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
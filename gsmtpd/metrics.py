@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Counters and latency histograms of :class:`gsmtpd.server.SMTPServer`
+
+Enabled by the `metrics` argument of the server, and served in the
+Prometheus text format by `metrics_localaddr`
+
+.. code:: python
+
+    server = MyServer(('0.0.0.0', 25), metrics_localaddr=('127.0.0.1', 9125))
+
+    $ curl http://127.0.0.1:9125/metrics
+
+The histograms have fixed buckets, an observation is one bisect and one
+increment.  When the metrics are disabled the server and the sessions hold
+None instead of a :class:`Metrics` and skip the accounting after one check.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from bisect import bisect_left
+
+from gevent.pywsgi import WSGIServer
+
+__all__ = ['Metrics', 'Counter', 'Histogram']
+
+# seconds, from a reply sent from memory to a slow lookup or message handler
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Counter(object):
+    """Monotonic count, one per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: metric name, like `gsmtpd_sessions_total`
+        :param help: one line description
+        :param labels: names of the labels, their values are passed as a\n
+                       tuple in the same order to :meth:`inc`
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # tuple of label values -> count
+        self.values = {}
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self.values.iteritems()):
+            yield self.name + _labels(self.labels, labels), value
+
+
+class Histogram(object):
+    """Distribution of durations in fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        """
+        :param name: metric name, like `gsmtpd_command_seconds`
+        :param help: one line description
+        :param labels: names of the labels, see :class:`Counter`
+        :param buckets: sorted upper bounds of the buckets, a bucket for\n
+                        the bigger values is added
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # tuple of label values -> [count per bucket..., sum]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        bounds = [_number(bound) for bound in self.buckets] + ['+Inf']
+        for labels, counts in sorted(self.values.iteritems()):
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                yield (self.name + '_bucket' +
+                       _labels(self.labels, labels, 'le="%s"' % bound), total)
+            yield self.name + '_sum' + _labels(self.labels, labels), counts[-1]
+            yield self.name + '_count' + _labels(self.labels, labels), total
+
+
+class Metrics(object):
+    """The metrics of one server and its sessions"""
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: upper bounds in seconds of the histogram buckets
+        """
+        self.sessions = Counter('gsmtpd_sessions_total', 'Sessions accepted')
+        self.rejected = Counter('gsmtpd_sessions_rejected_total',
+                                'Connections refused by the load limits')
+        self.timeouts = Counter('gsmtpd_timeouts_total',
+                                'Sessions closed by a timeout')
+        self.replies = Counter('gsmtpd_replies_total',
+                               'Replies by command and reply class',
+                               ('command', 'reply'))
+        self.bytes = Counter('gsmtpd_bytes_total',
+                             'Bytes received from and sent to the clients',
+                             ('direction',))
+        self.tls = Counter('gsmtpd_tls_total',
+                           'Sessions upgraded to TLS', ('mode',))
+        self.banner = Histogram('gsmtpd_banner_seconds',
+                                'From the new connection to the banner sent, '
+                                'including an implicit TLS handshake',
+                                buckets=buckets)
+        self.commands = Histogram('gsmtpd_command_seconds',
+                                  'Duration of the command handlers',
+                                  ('command',), buckets)
+        self.rcpt_lookups = Histogram('gsmtpd_rcpt_lookup_seconds',
+                                      'Duration of a batch of RCPT lookups',
+                                      buckets=buckets)
+        self.data = Histogram('gsmtpd_data_seconds',
+                              'From DATA or the first BDAT to the end of '
+                              'the message data', buckets=buckets)
+        self.processing = Histogram('gsmtpd_process_message_seconds',
+                                    'Time the client waits for the message '
+                                    'to be processed or queued',
+                                    buckets=buckets)
+
+    def collectors(self):
+        return [value for value in self.__dict__.itervalues()
+                if isinstance(value, (Counter, Histogram))]
+
+    def render(self, gauges=None):
+        """Return all the metrics in the Prometheus text format
+
+        :param gauges: dict of current values to export too, like\n
+                       :meth:`gsmtpd.server.SMTPServer.stats`, nested dicts\n
+                       are flattened with `_`
+        """
+        lines = []
+        for collector in sorted(self.collectors(), key=lambda c: c.name):
+            lines.append('# HELP %s %s' % (collector.name, collector.help))
+            lines.append('# TYPE %s %s' % (collector.name, collector.kind))
+            for name, value in collector.samples():
+                lines.append('%s %s' % (name, _number(value)))
+        for name, value in sorted(_flatten('gsmtpd', gauges or {})):
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def listen(self, localaddr, gauges=None):
+        """Return a started HTTP server of the metrics on the current hub
+
+        :param localaddr: tuple pair of the listener, like `('127.0.0.1', 9125)`
+        :param gauges: function returning the `gauges` of :meth:`render`
+        """
+        def application(environ, start_response):
+            if environ['PATH_INFO'] not in ('/', '/metrics'):
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return ['Not Found\n']
+            body = self.render(gauges() if gauges is not None else None)
+            start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+
+        server = WSGIServer(localaddr, application, log=None)
+        server.start()
+        logger.info('Metrics on http://%s:%s/metrics', *server.address[:2])
+        return server
+
+
+def _flatten(prefix, values):
+    for key, value in values.iteritems():
+        name = '%s_%s' % (prefix, key)
+        if isinstance(value, dict):
+            for item in _flatten(name, value):
+                yield item
+        elif isinstance(value, (int, long, float)):
+            yield name, value
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Keep-alive connections to an upstream smtpd, used by
+:class:`gsmtpd.server.PureProxy`
+
+Example
+
+.. code:: python
+
+    pool = ConnectionPool('mx.example.org', 25, size=20)
+    with pool.connection() as conn:
+        conn.sendmail(mailfrom, rcpttos, data)
+
+A connection is kept open after the message and the next one reuses it,
+after a failed transaction it is RSET first.  A connection idle for more
+than `check_after` seconds is checked with NOOP before reuse, one idle for
+more than `idle_timeout` seconds is closed.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import smtplib
+import time
+from contextlib import contextmanager
+
+import gevent
+from gevent import socket
+from gevent.lock import BoundedSemaphore
+
+__all__ = ['ConnectionPool']
+
+
+class ConnectionPool(object):
+    """Bounded pool of :class:`smtplib.SMTP` connections to one next hop"""
+
+    def __init__(self, host, port=25, size=10, idle_timeout=60,
+                 check_after=5, timeout=30, local_hostname=None):
+        """
+        :param host: address of the upstream smtpd
+        :param port: port of the upstream smtpd
+        :param size: max connections open at the same time, more callers wait
+        :param idle_timeout: seconds an unused connection is kept open
+        :param check_after: seconds of idleness after which a connection\n
+                            is checked with NOOP before it is reused
+        :param timeout: socket timeout of the connections
+        :param local_hostname: name sent in EHLO, see :class:`smtplib.SMTP`
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.timeout = timeout
+        self.local_hostname = local_hostname
+        self.semaphore = BoundedSemaphore(size)
+        # (connection, last used), the most recently used at the end
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self._evictor = None
+
+    def __len__(self):
+        return len(self.idle)
+
+    def stats(self):
+        return dict(idle=len(self.idle), busy=self.size - self.semaphore.counter,
+                    created=self.created, reused=self.reused,
+                    evicted=self.evicted)
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, self.local_hostname,
+                            self.timeout)
+        conn.ehlo_or_helo_if_needed()
+        self.created += 1
+        logger.debug('Connected to %s:%s', self.host, self.port)
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.quit()
+        except (socket.error, smtplib.SMTPException):
+            conn.close()
+
+    def _healthy(self, conn):
+        try:
+            return conn.noop()[0] == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
+
+    def get(self):
+        """Take a connection, waiting while `size` are in use"""
+        self.semaphore.acquire()
+        try:
+            now = time.time()
+            while self.idle:
+                conn, used = self.idle.pop()
+                if now - used > self.idle_timeout:
+                    self.evicted += 1
+                    self._close(conn)
+                    continue
+                if now - used > self.check_after and not self._healthy(conn):
+                    self.evicted += 1
+                    conn.close()
+                    continue
+                self.reused += 1
+                return conn
+            return self._connect()
+        except:
+            self.semaphore.release()
+            raise
+
+    def put(self, conn, reset=False):
+        """Give back a connection taken with :meth:`get`
+
+        :param reset: send RSET first, for a connection whose last\n
+                      transaction failed
+        """
+        try:
+            if reset:
+                try:
+                    if conn.rset()[0] != 250:
+                        raise smtplib.SMTPException('RSET refused')
+                except (socket.error, smtplib.SMTPException):
+                    conn.close()
+                    return
+            self.idle.append((conn, time.time()))
+            if self._evictor is None:
+                self._evictor = gevent.spawn(self._evict)
+        finally:
+            self.semaphore.release()
+
+    def discard(self, conn):
+        """Close a broken connection taken with :meth:`get` instead of
+        giving it back
+        """
+        try:
+            conn.close()
+        finally:
+            self.semaphore.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager around :meth:`get` and :meth:`put`"""
+        conn = self.get()
+        try:
+            yield conn
+        except smtplib.SMTPServerDisconnected:
+            self.discard(conn)
+            raise
+        except smtplib.SMTPException:
+            # the connection works, only the transaction failed
+            self.put(conn, reset=True)
+            raise
+        except:
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def _evict(self):
+        try:
+            while self.idle:
+                gevent.sleep(min(self.idle_timeout, self.check_after))
+                deadline = time.time() - self.idle_timeout
+                # the oldest are at the beginning
+                while self.idle and self.idle[0][1] < deadline:
+                    conn = self.idle.pop(0)[0]
+                    self.evicted += 1
+                    self._close(conn)
+        finally:
+            self._evictor = None
+
+    def close(self):
+        if self._evictor is not None:
+            self._evictor.kill(block=False)
+            self._evictor = None
+        idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self._close(conn)
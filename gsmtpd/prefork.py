@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Run a :class:`gsmtpd.server.SMTPServer` in several worker processes
+
+Example
+
+.. code:: python
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    from gsmtpd.prefork import PreforkServer
+
+    PreforkServer(PrintSMTPServer(('0.0.0.0', 25)), workers=8).serve_forever()
+
+Every worker is a forked copy of the supervisor with its own gevent hub.
+With SO_REUSEPORT each worker listens on its own socket and the kernel
+spreads the connections, otherwise the workers share the listening socket
+bound by the supervisor.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import errno
+import os
+import signal
+import time
+import multiprocessing
+
+from gevent import socket
+try:
+    from gevent import signal_handler
+except ImportError:  # gevent < 1.5
+    from gevent import signal as signal_handler
+
+__all__ = ['PreforkServer']
+
+
+class PreforkServer(object):
+    """Supervisor of the worker processes"""
+
+    # a worker dying sooner than this after its start is restarted late
+    min_lifetime = 1
+
+    def __init__(self, server, workers=None, reuse_port=None, backlog=128):
+        """
+        :param server: :class:`gsmtpd.server.SMTPServer` that is not started yet
+        :param workers: number of worker processes, default is the number of CPUs
+        :param reuse_port: give each worker its own SO_REUSEPORT socket,\n
+                           default is True where the platform supports it
+        :param backlog: listen backlog of the sockets
+        """
+        self.server = server
+        self.workers = workers or multiprocessing.cpu_count()
+        if reuse_port is None:
+            reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.socket = None
+        self.address = None
+        self.children = {}
+        self.stopping = False
+
+    @staticmethod
+    def journal_dir(directory, index):
+        """Journal directory of the worker in slot `index`"""
+        return os.path.join(directory, 'worker-%d' % index)
+
+    def bind(self, listen):
+        sock = socket.socket(self.server.family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address or self.server.address)
+        if listen:
+            sock.listen(self.backlog)
+        return sock
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (index, time.time())
+            logger.debug('Worker %d started as %d', index, pid)
+            return
+        code = 0
+        try:
+            self.run_worker(index)
+        except Exception as err:
+            logger.error(err, exc_info=True)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def run_worker(self, index=0):
+        # the supervisor forwards SIGTERM, a terminal ^C should not reach us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        journal = self.server.journal
+        if journal is not None:
+            # workers must not recover and append to the same segments, a
+            # worker restarted in the same slot recovers what its
+            # predecessor left behind
+            journal.directory = self.journal_dir(journal.directory, index)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.reuse_port:
+            sock = self.bind(True)
+            self.socket.close()
+        else:
+            sock = self.socket
+        self.server.set_listener(sock)
+        signal_handler(signal.SIGTERM, self.server.stop)
+        self.server.serve_forever()
+
+    def serve_forever(self):
+        """Start the workers and supervise them until :meth:`stop`"""
+        # with SO_REUSEPORT the socket of the supervisor only holds the port,
+        # it does not listen so the kernel never hands it a connection
+        self.socket = self.bind(not self.reuse_port)
+        self.address = self.socket.getsockname()
+        # resolve once for every worker
+        logger.debug('Hostname %s', self.server.fqdn)
+        logger.info('Serving on %s:%s with %d workers',
+                    self.address[0], self.address[1], self.workers)
+
+        journal = self.server.journal
+        if journal is not None and os.path.isdir(journal.directory):
+            for name in os.listdir(journal.directory):
+                if (name.startswith('worker-') and name[7:].isdigit() and
+                        int(name[7:]) >= self.workers):
+                    logger.warn('No worker recovers the journal in %s',
+                                os.path.join(journal.directory, name))
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in xrange(self.workers):
+            self.spawn(index)
+
+        try:
+            while self.children:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError as err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    if err.errno == errno.ECHILD:
+                        break
+                    raise
+                if pid not in self.children:
+                    continue
+                index, started = self.children.pop(pid)
+                if self.stopping:
+                    continue
+                logger.error('Worker %d (%d) exited with status %d',
+                             index, pid, status)
+                if time.time() - started < self.min_lifetime:
+                    time.sleep(self.min_lifetime)
+                if not self.stopping:
+                    self.spawn(index)
+        finally:
+            self.socket.close()
+
+    def stop(self, *args):
+        """Gracefully stop the workers, also the handler of SIGTERM/SIGINT"""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Deferred delivery of the messages an upstream refused temporarily, used by
+:class:`gsmtpd.server.PureProxy`
+
+Every deferred message is kept in `directory` as two files, ``<id>.eml``
+with the data and ``<id>.json`` with the envelope and the state of the
+retries, so a restart picks them up again.  A heap ordered by the time of
+the next attempt tells the scheduler greenlet what is due.  The delay
+doubles after every failed attempt (with some jitter, so that messages
+deferred together by an outage do not come back together), attempts to
+one destination are limited to `concurrency` at a time, and a message
+still not delivered after `expire` seconds is bounced.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import errno
+import heapq
+import json
+import os
+import random
+import time
+import uuid
+
+import gevent
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group
+
+__all__ = ['RetryQueue', 'Deferred']
+
+COMMASPACE = ', '
+
+
+def temporary(code):
+    """Whether a refusal code returned by :meth:`smtplib.SMTP.sendmail`
+    is worth another attempt, -1 stands for a connection error
+    """
+    return code < 500
+
+
+class Deferred(object):
+    """State of one deferred message"""
+
+    def __init__(self, id, mailfrom, rcpttos, destination,
+                 created=None, attempts=0, next_attempt=0, errors=None):
+        self.id = id
+        self.mailfrom = mailfrom
+        self.rcpttos = rcpttos
+        self.destination = destination
+        self.created = created or time.time()
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        # rcpt -> [code, message] of the last attempt
+        self.errors = errors or {}
+
+    def dumps(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def loads(cls, text):
+        return cls(**json.loads(text))
+
+
+class RetryQueue(object):
+    """On-disk queue of messages waiting for another delivery attempt"""
+
+    def __init__(self, directory, deliver, bounce=None, backoff=60,
+                 max_backoff=3600, expire=5 * 24 * 3600, concurrency=2,
+                 jitter=0.2):
+        """
+        :param directory: directory of the deferred messages, created if missing
+        :param deliver: called as `deliver(mailfrom, rcpttos, data)` for\n
+                        every attempt, returns a dict of the refused\n
+                        recipients like :meth:`smtplib.SMTP.sendmail`
+        :param bounce: called as `bounce(deferred, data)` when a message\n
+                       is given up, `deferred.errors` tells why
+        :param backoff: seconds before the first retry
+        :param max_backoff: max seconds between two attempts
+        :param expire: seconds after which a message is given up
+        :param concurrency: max attempts running at the same time for\n
+                            one destination
+        :param jitter: fraction by which the delays are randomly stretched\n
+                       or shrunk
+        """
+        self.directory = directory
+        self.deliver = deliver
+        self.bounce = bounce
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.expire = expire
+        self.concurrency = concurrency
+        self.jitter = jitter
+        # id -> Deferred
+        self.entries = {}
+        # (next attempt, id)
+        self.heap = []
+        # destination -> BoundedSemaphore
+        self.limits = {}
+        self.attempts = Group()
+        self.delivered = 0
+        self.bounced = 0
+        self._wakeup = Event()
+        self._scheduler = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return dict(deferred=len(self.entries), running=len(self.attempts),
+                    delivered=self.delivered, bounced=self.bounced)
+
+    def _path(self, entry, suffix):
+        return os.path.join(self.directory, entry.id + suffix)
+
+    def _fsync(self, f):
+        # in the threadpool, an outage defers many messages at once and
+        # the sessions must not wait for the disk meanwhile
+        f.flush()
+        gevent.get_hub().threadpool.apply(os.fsync, (f.fileno(),))
+
+    def _save(self, entry):
+        path = self._path(entry, '.json')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(entry.dumps())
+            self._fsync(f)
+        os.rename(path + '.tmp', path)
+
+    def _remove(self, entry):
+        self.entries.pop(entry.id, None)
+        for suffix in ('.json', '.eml'):
+            try:
+                os.unlink(self._path(entry, suffix))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    logger.error(err)
+
+    def _read(self, entry):
+        with open(self._path(entry, '.eml'), 'rb') as f:
+            return f.read()
+
+    def _schedule(self, entry, delay):
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        entry.next_attempt = time.time() + delay
+        self._save(entry)
+        self.entries[entry.id] = entry
+        heapq.heappush(self.heap, (entry.next_attempt, entry.id))
+        self._wakeup.set()
+
+    def start(self):
+        """Load the deferred messages and start the scheduler"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        names = set(os.listdir(self.directory))
+        for name in names:
+            if (name.endswith('.json.tmp') or name.endswith('.eml') and
+                    name[:-len('.eml')] + '.json' not in names):
+                # left by a crash before the state was saved
+                logger.warn('Removing the orphan %s', name)
+                os.unlink(os.path.join(self.directory, name))
+                continue
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                entry = Deferred.loads(f.read())
+            self.entries[entry.id] = entry
+            heapq.heappush(self.heap, (entry.next_attempt, entry.id))
+        if self.entries:
+            logger.info('Loaded %d deferred messages', len(self.entries))
+        if self._scheduler is None:
+            self._scheduler = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._scheduler is not None:
+            self._scheduler.kill(block=False)
+            self._scheduler = None
+        self.attempts.kill(block=False)
+
+    def add(self, mailfrom, refused, data, destination=None):
+        """Defer the recipients refused temporarily, bounce the others
+
+        :param refused: dict of the refused recipients returned by\n
+                        :meth:`smtplib.SMTP.sendmail`
+        :param destination: string naming the destination the concurrency\n
+                            limit applies to, like the next hop
+        """
+        entry = Deferred(uuid.uuid4().hex, mailfrom, [], destination)
+        permanent = {}
+        for rcpt, (code, msg) in refused.iteritems():
+            if temporary(code):
+                entry.rcpttos.append(rcpt)
+                entry.errors[rcpt] = [code, msg]
+            else:
+                permanent[rcpt] = [code, msg]
+        if permanent:
+            self._bounce(Deferred(entry.id, mailfrom, list(permanent),
+                                  destination, errors=permanent), data)
+        if not entry.rcpttos:
+            return
+        with open(self._path(entry, '.eml'), 'wb') as f:
+            f.write(data)
+            self._fsync(f)
+        entry.attempts = 1
+        self._schedule(entry, self.backoff)
+        logger.info('Deferred %s to %s', entry.id, COMMASPACE.join(entry.rcpttos))
+
+    def _bounce(self, entry, data):
+        self.bounced += 1
+        logger.warn('Giving up %s to %s', entry.id, COMMASPACE.join(entry.rcpttos))
+        if self.bounce is None:
+            return
+        try:
+            self.bounce(entry, data)
+        except Exception as err:
+            logger.error(err, exc_info=True)
+
+    def _run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, entry_id = heapq.heappop(self.heap)
+                entry = self.entries.get(entry_id)
+                if entry is not None:
+                    self.attempts.spawn(self._attempt, entry)
+            self._wakeup.clear()
+            self._wakeup.wait(self.heap[0][0] - now if self.heap else None)
+
+    def _attempt(self, entry):
+        limit = self.limits.get(entry.destination)
+        if limit is None:
+            limit = self.limits[entry.destination] = \
+                BoundedSemaphore(self.concurrency)
+        with limit:
+            try:
+                data = self._read(entry)
+            except EnvironmentError as err:
+                # no attempt can bring the data back, give it up now
+                logger.error('Deferred %s unreadable: %s', entry.id, err)
+                entry.errors = dict((rcpt, [-1, 'message data lost'])
+                                    for rcpt in entry.rcpttos)
+                self._bounce(entry, '')
+                self._remove(entry)
+                return
+            try:
+                refused = self.deliver(entry.mailfrom, entry.rcpttos, data)
+            except Exception as err:
+                logger.error(err, exc_info=True)
+                refused = dict((rcpt, (-1, str(err))) for rcpt in entry.rcpttos)
+        entry.attempts += 1
+        delivered = len(entry.rcpttos) - len(refused)
+        self.delivered += delivered
+        permanent = {}
+        entry.rcpttos = []
+        entry.errors = {}
+        for rcpt, (code, msg) in refused.iteritems():
+            if temporary(code):
+                entry.rcpttos.append(rcpt)
+                entry.errors[rcpt] = [code, msg]
+            else:
+                permanent[rcpt] = [code, msg]
+        if permanent:
+            self._bounce(Deferred(entry.id, entry.mailfrom, list(permanent),
+                                  entry.destination, entry.created,
+                                  entry.attempts, errors=permanent), data)
+        if not entry.rcpttos:
+            self._remove(entry)
+            return
+        if time.time() - entry.created > self.expire:
+            self._bounce(entry, data)
+            self._remove(entry)
+            return
+        delay = min(self.backoff * 2 ** (entry.attempts - 1), self.max_backoff)
+        self._schedule(entry, delay)
+
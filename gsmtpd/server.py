@@ -17,9 +17,9 @@ An RFC 2821 smtp proxy server port from Python Standrad Library for Gevent usage
 #   DebuggingServer - simply prints each message it receives on stdout.
 #
 #   PureProxy - Proxies all messages to a real smtpd which does final
-#   delivery.  One known problem with this class is that it doesn't handle
-#   SMTP errors from the backend server at all.  This should be fixed
-#   (contributions are welcome!).
+#   delivery over a pool of keep-alive connections.  One known problem with
+#   this class is that it doesn't handle SMTP errors from the backend server
+#   at all.  This should be fixed (contributions are welcome!).
 #
 # Please note that this script requires Python 2.7
 #
@@ -37,25 +37,71 @@ logger = logging.getLogger(__name__)
 
 from UserDict import UserDict
 
-from gevent import socket, monkey, Timeout
+import gevent
+from gevent import socket, monkey
 monkey.patch_all()
 from gevent.server import StreamServer
 
 
+import os
+import smtplib
 import ssl
+import time
+from email.utils import parseaddr
 from ssl import CERT_NONE
 
 from .channel import SMTPChannel
+from .timer import TimerWheel, ConnectionTimeout
+from .message import MessageBuffer
+from .handoff import MessageQueue
+from .journal import Journal
+from .pool import ConnectionPool
+from .acl import ACL
+from .cache import RcptCache
+from .retry import RetryQueue
+from .metrics import Metrics
 
 __all__ = ["SMTPServer", "DebuggingServer", "PureProxy", 'SSLSettings']
 
-class ConnectionTimeout(Exception):
-    pass
-
 NEWLINE = '\n'
 EMPTYSTRING = ''
 COMMASPACE = ', '
 
+BOUNCE = '''From: Mail Delivery System <MAILER-DAEMON@%(fqdn)s>
+To: <%(mailfrom)s>
+Subject: Undelivered Mail Returned to Sender
+Auto-Submitted: auto-replied
+
+This is the mail system at host %(fqdn)s.
+
+Your message could not be delivered to the following recipients:
+
+%(errors)s
+
+--- Headers of the message follow ---
+
+%(headers)s
+'''
+
+def insert_header(data, header):
+    """Return `data` with `header` added before the empty line ending the
+    headers
+
+    :param data: message text, a string or the :class:`mmap.mmap` of a\n
+                 spooled message, which is searched without splitting it
+    """
+    if data[:1] in ('', NEWLINE):
+        end = 0
+    else:
+        end = data.find(NEWLINE * 2) + 1
+        if not end:
+            if data[-1:] != NEWLINE:
+                # no body and no final newline
+                return data[:] + NEWLINE + header
+            end = len(data)
+    return data[:end] + header + NEWLINE + data[end:]
+
+
 class SSLSettings(UserDict):
     """SSL settings object"""
     def __init__(self, keyfile=None, certfile=None,
@@ -78,24 +124,152 @@ class SSLSettings(UserDict):
                                 suppress_ragged_eofs = suppress_ragged_eofs,
                                 ciphers = ciphers))
 
+    def context(self):
+        """Build a :class:`ssl.SSLContext` of the settings
+
+        The key and certificate files are read here once, sockets wrapped
+        by the same context share its session cache and ticket keys.
+        """
+        context = ssl.SSLContext(self['ssl_version'])
+        context.load_cert_chain(self['certfile'], self['keyfile'])
+        context.verify_mode = self['cert_reqs']
+        if self['ca_certs']:
+            context.load_verify_locations(self['ca_certs'])
+        if self['ciphers']:
+            context.set_ciphers(self['ciphers'])
+        return context
+
+    def files(self):
+        """Paths of the key and certificate files"""
+        return [self[name] for name in ('certfile', 'keyfile', 'ca_certs')
+                if self[name]]
+
 
 class SMTPServer(StreamServer):
     """Abstrcted SMTP server
     """
 
+    # class of the sessions, a subclass of SMTPChannel adds or overrides commands
+    channel_class = SMTPChannel
+
+    # Lifecycle hooks, None or a function set on the server (or a method of
+    # a subclass) called by the session with the channel, whose `peer`,
+    # `mailfrom`, `rcpttos`, `received` and `sent` bytes tell the rest.
+    # Timestamps come from time.time(), durations are in seconds.
+    #
+    #   on_connect(channel, timestamp) before the banner
+    #   on_command(channel, command, arg, started, duration) after a command
+    #   on_data_start(channel, timestamp) on DATA or the first BDAT
+    #   on_data_end(channel, timestamp, size) after the end of the data
+    #   on_message_processed(channel, started, duration, status) after
+    #       process_message_end, `status` is its reply or None
+    #   on_close(channel, timestamp) when the session is closed
+    on_connect = None
+    on_command = None
+    on_data_start = None
+    on_data_end = None
+    on_message_processed = None
+    on_close = None
+
     def __init__(self, localaddr=None, remoteaddr=None, 
-                 timeout=60, data_size_limit=10240000, **kwargs):
+                 timeout=60, data_size_limit=10240000,
+                 spool_threshold=None, spool_dir=None,
+                 hostname=None, hostname_refresh=None,
+                 max_sessions=None, max_sessions_per_ip=None,
+                 max_loop_lag=None, greeting_timeout=None,
+                 data_block_timeout=None, data_timeout=None,
+                 session_timeout=None, queue_size=None, queue_workers=10,
+                 queue_threads=False, journal_dir=None, journal_commit=0,
+                 ssl_reload=60, implicit_tls=False, smtps_localaddr=None,
+                 rcpt_cache=None, rcpt_cache_ttl=300, rcpt_cache_negative_ttl=60,
+                 metrics=False, metrics_localaddr=None,
+                 **kwargs):
         """Initialize SMTP Server
 
         :param localaddr: tuple pair that start server, like `('127.0.0.1', 25)`
-        :param remoteaddr: ip address (string or list) that can relay on this server
-        :param timeout: int that connection Timeout
+        :param remoteaddr: addresses or CIDR networks (string or list) of the clients\n
+                           allowed to connect, or a :class:`gsmtpd.acl.ACL`
+        :param timeout: seconds a client may stay idle between two commands
         :param data_size_limit: max byte per mail data
+        :param spool_threshold: max byte of a mail kept in memory, bigger mails\n
+                                are spooled to a temporary file, None never spools
+        :param spool_dir: directory of the spool files, default is the system temp dir
+        :param hostname: name in the banner and HELO/EHLO replies, default is\n
+                         :func:`socket.getfqdn` resolved once when the server starts
+        :param hostname_refresh: seconds between two resolutions of the default\n
+                                 hostname, None resolves it only once
+        :param max_sessions: max concurrent sessions, more connections are\n
+                             answered with `421 Too busy' and closed
+        :param max_sessions_per_ip: max concurrent sessions of one client address
+        :param max_loop_lag: seconds the gevent loop may lag behind its timers,\n
+                             new connections are refused while it lags more
+        :param greeting_timeout: seconds from the banner to the first command,\n
+                                 default is `timeout`
+        :param data_block_timeout: seconds a client may stay idle while sending\n
+                                   message data, default is `timeout`
+        :param data_timeout: max seconds from DATA or the first BDAT to the end\n
+                             of the message, None for no limit
+        :param session_timeout: max seconds of a whole session, None for no limit
+        :param queue_size: hand the messages to :meth:`process_message` through\n
+                           a queue of this many messages, the client gets `250'\n
+                           once its message is queued. None calls it in the session
+        :param queue_workers: number of workers consuming the queue
+        :param queue_threads: run :meth:`process_message` in the threadpool of\n
+                              the gevent hub instead of in greenlets
+        :param journal_dir: directory of a journal the queued messages are\n
+                            written to before the client gets `250', messages\n
+                            not processed by a crash are processed again on the\n
+                            next start. A message whose :meth:`process_message`\n
+                            raised is logged and acknowledged, not processed\n
+                            again. Implies a queue, of 1000 messages if no\n
+                            `queue_size' is given. One directory per process,\n
+                            :class:`.PreforkServer` gives each worker its own
+        :param journal_commit: seconds between two fsync of the journal, the\n
+                               messages accepted meanwhile share the fsync
+        :param ssl_reload: seconds between two checks of the modification time\n
+                           of the key and certificate files, the SSL context is\n
+                           built again when they change. None never checks
+        :param implicit_tls: clients of `localaddr` start with the TLS handshake\n
+                             instead of STARTTLS, like on port 465
+        :param smtps_localaddr: tuple pair of a second listener with implicit TLS,\n
+                                like `('0.0.0.0', 465)`, sharing the sessions\n
+                                and handlers of this server. Bound by every\n
+                                worker, so not for :class:`.PreforkServer`
+        :param rcpt_cache: number of addresses whose :meth:`process_rcpt` result\n
+                           is cached, None calls it for every RCPT
+        :param rcpt_cache_ttl: seconds an accepted address is cached
+        :param rcpt_cache_negative_ttl: seconds a refused address is cached
+        :param metrics: count the sessions, replies and bytes and time the\n
+                        commands and messages, True or a :class:`gsmtpd.metrics.Metrics`
+        :param metrics_localaddr: tuple pair of an HTTP listener serving the\n
+                                  metrics and :meth:`stats` in the Prometheus\n
+                                  text format, implies `metrics`. Bound by every\n
+                                  worker, so not for :class:`.PreforkServer`
         :param kwargs: other key-arguments will pass to :class:`.SSLSettings`
         """
 
+        self.rcpt_cache = None
+        if rcpt_cache:
+            self.rcpt_cache = RcptCache(self.process_rcpt, rcpt_cache,
+                                        rcpt_cache_ttl, rcpt_cache_negative_ttl)
+
+        self.metrics = None
+        if isinstance(metrics, Metrics):
+            self.metrics = metrics
+        elif metrics or metrics_localaddr:
+            self.metrics = Metrics()
+        self.metrics_localaddr = metrics_localaddr
+        self.metrics_server = None
+
         self.relay = bool(remoteaddr)
         self.remoteaddr = remoteaddr
+        self.acl = None
+        if isinstance(remoteaddr, ACL):
+            self.acl = remoteaddr
+        elif remoteaddr:
+            if isinstance(remoteaddr, basestring):
+                remoteaddr = [remoteaddr]
+            self.acl = ACL(allow=remoteaddr)
         
         self.localaddr = localaddr
 
@@ -104,36 +278,258 @@ class SMTPServer(StreamServer):
         
         self.ssl = None
         
-        self.timeout = int(timeout)
+        self.timeout = timeout
+        self.greeting_timeout = greeting_timeout or timeout
+        self.data_block_timeout = data_block_timeout or timeout
+        self.data_timeout = data_timeout
+        self.session_timeout = session_timeout
+        self.timers = TimerWheel()
 
         self.data_size_limit = int(data_size_limit)
 
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+
+        self.hostname = hostname
+        self.hostname_refresh = hostname_refresh
+        self._fqdn = hostname
+        self._fqdn_refresher = None
+
+        self.max_sessions = max_sessions
+        self.max_sessions_per_ip = max_sessions_per_ip
+        self.max_loop_lag = max_loop_lag
+        self.sessions = 0
+        self.sessions_per_ip = {}
+        self.rejected = 0
+        self.loop_lag = 0.0
+        self._lag_watcher = None
+
+        self.journal = None
+        if journal_dir:
+            self.journal = Journal(journal_dir, journal_commit)
+            queue_size = queue_size or 1000
+
+        self.queue = None
+        if queue_size:
+            self.queue = MessageQueue(self._process_queued, queue_size,
+                                      queue_workers, queue_threads,
+                                      self._processed)
+        self._redeliverer = None
+
+        self.ssl_context = None
+        self.ssl_reload = ssl_reload
+        self._ssl_mtimes = None
+        self._ssl_watcher = None
         if 'keyfile' in kwargs:
             self.ssl = SSLSettings(**kwargs)
+            # built before a PreforkServer forks, so that the workers share
+            # the ticket keys and resume each other's sessions
+            self.reload_ssl()
+        elif implicit_tls or smtps_localaddr:
+            raise ValueError('implicit TLS needs keyfile and certfile')
+        self.implicit_tls = implicit_tls
+        self.smtps_localaddr = smtps_localaddr
+        self.smtps_server = None
 
         super(SMTPServer, self).__init__(self.localaddr, self.handle)
 
-    def handle(self, sock, addr):
+    @property
+    def fqdn(self):
+        """Name of this server shown to the clients"""
+        if self._fqdn is None:
+            self._fqdn = socket.getfqdn()
+        return self._fqdn
+
+    def _refresh_fqdn(self):
+        while True:
+            gevent.sleep(self.hostname_refresh)
+            self._fqdn = socket.getfqdn()
+            logger.debug('Refreshed hostname %s', self._fqdn)
+
+    def _stat_ssl_files(self):
+        mtimes = []
+        for path in self.ssl.files():
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload_ssl(self):
+        """Build the SSL context again from the key and certificate files"""
+        mtimes = self._stat_ssl_files()
+        self.ssl_context = self.ssl.context()
+        self._ssl_mtimes = mtimes
+
+    def _watch_ssl_files(self):
+        while True:
+            gevent.sleep(self.ssl_reload)
+            mtimes = self._stat_ssl_files()
+            if mtimes == self._ssl_mtimes:
+                continue
+            # a half written file is tried again when it changes next
+            self._ssl_mtimes = mtimes
+            try:
+                self.ssl_context = self.ssl.context()
+                logger.info('Reloaded %s', COMMASPACE.join(self.ssl.files()))
+            except (EnvironmentError, ssl.SSLError) as err:
+                logger.error('Keeping the old certificate: %s', err)
+
+    def wrap_ssl(self, sock):
+        """Start TLS on `sock` as the server side"""
+        return self.ssl_context.wrap_socket(
+            sock, server_side=True,
+            do_handshake_on_connect=self.ssl['do_handshake_on_connect'],
+            suppress_ragged_eofs=self.ssl['suppress_ragged_eofs'])
+
+    def _watch_loop_lag(self, interval=0.1):
+        while True:
+            started = time.time()
+            gevent.sleep(interval)
+            lag = max(time.time() - started - interval, 0)
+            # moving average, a single slow iteration should not shed load
+            self.loop_lag = self.loop_lag * 0.7 + lag * 0.3
+
+    def start(self):
+        # resolve before the first connection, not in every one of them
+        logger.debug('Hostname %s', self.fqdn)
+        if (self.hostname is None and self.hostname_refresh and
+                self._fqdn_refresher is None):
+            self._fqdn_refresher = gevent.spawn(self._refresh_fqdn)
+        if self.max_loop_lag and self._lag_watcher is None:
+            self._lag_watcher = gevent.spawn(self._watch_loop_lag)
+        if self.ssl and self.ssl_reload and self._ssl_watcher is None:
+            self._ssl_watcher = gevent.spawn(self._watch_ssl_files)
+        if self.smtps_localaddr and self.smtps_server is None:
+            self.smtps_server = StreamServer(self.smtps_localaddr,
+                                             self.handle_tls)
+            self.smtps_server.start()
+        if self.metrics_localaddr and self.metrics_server is None:
+            self.metrics_server = self.metrics.listen(self.metrics_localaddr,
+                                                      self.stats)
+        if self.queue is not None:
+            self.queue.start()
+        if self.journal is not None and self._redeliverer is None:
+            self._redeliverer = gevent.spawn(self._redeliver,
+                                             self.journal.recover())
+        super(SMTPServer, self).start()
+
+    def stop(self, timeout=None):
+        for greenlet in (self._fqdn_refresher, self._lag_watcher,
+                         self._redeliverer, self._ssl_watcher):
+            if greenlet is not None:
+                greenlet.kill(block=False)
+        self._fqdn_refresher = self._lag_watcher = None
+        self._redeliverer = self._ssl_watcher = None
+        if self.smtps_server is not None:
+            self.smtps_server.stop(timeout)
+            self.smtps_server = None
+        if self.metrics_server is not None:
+            self.metrics_server.stop(timeout)
+            self.metrics_server = None
+        super(SMTPServer, self).stop(timeout)
+        if self.queue is not None:
+            self.queue.stop(timeout)
+        if self.journal is not None:
+            self.journal.close()
+        self.timers.stop()
+
+    def stats(self):
+        """Current load of the server
+
+        :returns: dict of the number of `sessions`, the number of client\n
+                  addresses in `peers`, the number of connections `rejected`\n
+                  so far and the `loop_lag` in seconds. With a queue also\n
+                  the `queue` stats of :meth:`.MessageQueue.stats`, with a\n
+                  journal the number of messages `pending` in it and of `commits`,\n
+                  with a recipient cache its `rcpt_cache` stats
+        """
+        stats = dict(sessions=self.sessions,
+                     peers=len(self.sessions_per_ip),
+                     rejected=self.rejected,
+                     loop_lag=self.loop_lag)
+        if self.queue is not None:
+            stats['queue'] = self.queue.stats()
+        if self.rcpt_cache is not None:
+            stats['rcpt_cache'] = self.rcpt_cache.stats()
+        if self.journal is not None:
+            stats['journal'] = dict(pending=len(self.journal),
+                                    commits=self.journal.commits)
+        return stats
+
+    def overloaded(self, ip):
+        """Return why a new session of `ip` must be refused, or None"""
+        if self.max_sessions and self.sessions >= self.max_sessions:
+            return 'too many sessions'
+        if (self.max_sessions_per_ip and
+                self.sessions_per_ip.get(ip, 0) >= self.max_sessions_per_ip):
+            return 'too many sessions from %s' % ip
+        if self.max_loop_lag and self.loop_lag > self.max_loop_lag:
+            return 'loop lags %.3fs' % self.loop_lag
+
+    def handle_tls(self, sock, addr):
+        """Handler of the implicit TLS listener"""
+        self.handle(sock, addr, True)
+
+    def handle(self, sock, addr, tls=None):
 
         logger.debug('Incomming connection %s:%s', *addr[:2])
-
-        if self.relay and not addr[0] in self.remoteaddr:
-            logger.debug('Not in remoteaddr', *addr[:2])
-            return 
+        if tls is None:
+            tls = self.implicit_tls
+
+        if self.acl is not None and addr[0] not in self.acl:
+            logger.debug('%s:%s Not in remoteaddr', *addr[:2])
+            return
+
+        ip = addr[0]
+        reason = self.overloaded(ip)
+        if reason:
+            self.rejected += 1
+            if self.metrics is not None:
+                self.metrics.rejected.inc()
+            logger.warn('%s:%s Refused, %s', ip, addr[1], reason)
+            if tls:
+                # no handshake for a refused client, just close
+                return
+            try:
+                sock.sendall('421 %s Too busy, try again later\r\n' % self.fqdn)
+            except socket.error:
+                pass
+            return
+
+        self.sessions += 1
+        if self.metrics is not None:
+            self.metrics.sessions.inc()
+        self.sessions_per_ip[ip] = self.sessions_per_ip.get(ip, 0) + 1
+        try:
+            self.handle_session(sock, addr, tls)
+        finally:
+            self.sessions -= 1
+            count = self.sessions_per_ip.pop(ip) - 1
+            if count:
+                self.sessions_per_ip[ip] = count
+
+    def handle_session(self, sock, addr, tls=False):
+        sc = None
         try:
-            with Timeout(self.timeout, ConnectionTimeout):
-                sc = SMTPChannel(self, sock, addr, self.data_size_limit)
-                while not sc.closed:
-                    sc.handle_read()
+            sc = self.channel_class(self, sock, addr, self.data_size_limit, tls)
+            while not sc.closed:
+                sc.handle_read()
 
         except ConnectionTimeout:
             logger.warn('%s:%s Timeouted', *addr[:2])
-            try:
-                sc.smtp_TIMEOUT()
-            except Exception as err:
-                logger.debug(err)
+            if self.metrics is not None:
+                self.metrics.timeouts.inc()
+            if sc is not None:
+                try:
+                    sc.smtp_TIMEOUT()
+                except Exception as err:
+                    logger.debug(err)
         except Exception as err:
             logger.error(err)
+        finally:
+            if sc is not None and not sc.closed:
+                sc.close_when_done()
 
     # API for "doing something useful with the message"
     def process_message(self, peer, mailfrom, rcpttos, data):
@@ -149,13 +545,145 @@ class SMTPServer(StreamServer):
                      In other words, a line containing a `.' followed by other text has had the leading dot
         removed.
 
+        Messages bigger than `spool_threshold' are passed as a read-only
+        :class:`mmap.mmap` instead of a string, it is closed when this function returns.
+
         This function should return None, for a normal `250 Ok' response;
         otherwise it returns the desired response string in RFC 821 format.
 
+        With a `queue_size' it is called by a queue worker after the client
+        got `250 Ok: queued', a returned response is only logged then.
+
         """
         raise NotImplementedError
-    
+
+    # Streaming API, the default implementation buffers the whole message
+    # and hands it to process_message
+    def process_message_start(self, peer, mailfrom, rcpttos):
+        """Called when the client starts to send the message data.
+
+        Override it together with :meth:`process_message_chunk` and
+        :meth:`process_message_end` to handle the data while it arrives,
+        :meth:`process_message` is not called then.
+
+        :param peer: same as :meth:`process_message`
+        :param mailfrom: same as :meth:`process_message`
+        :param rcpttos: same as :meth:`process_message`
+
+        This function returns an object standing for the message, it is
+        passed to the other streaming methods.
+        """
+        return MessageBuffer(peer, mailfrom, rcpttos,
+                             self.spool_threshold, self.spool_dir)
+
+    def process_message_chunk(self, message, data):
+        """Called for every piece of message data received.
+
+        :param message: object returned by :meth:`process_message_start`
+        :param data: string of `de-transparencied' data like in\n
+                     :meth:`process_message`. Chunks may split a line anywhere.\n
+                     A BODY=BINARYMIME message sent with BDAT is passed as it is.
+        """
+        message.write(data)
+
+    def process_message_end(self, message):
+        """Called after the terminating `.' line.
+
+        :param message: object returned by :meth:`process_message_start`
+
+        This function should return None, for a normal `250 Ok' response;
+        otherwise it returns the desired response string in RFC 821 format.
+        """
+        if self.queue is not None:
+            return self._queue_message(message)
+        try:
+            return self.process_message(message.peer, message.mailfrom,
+                                        message.rcpttos, message.getvalue())
+        finally:
+            message.close()
+
+    def _queue_message(self, message):
+        try:
+            if self.journal is not None:
+                message.journal_id = self.journal.append(
+                    message.peer, message.mailfrom, message.rcpttos,
+                    message.getvalue())
+        except EnvironmentError as err:
+            logger.error('Journal failed: %s', err)
+            message.close()
+            return '451 Requested action aborted: local error in processing'
+        if self.queue.put(message, self.timeout):
+            return '250 Ok: queued'
+        if message.journal_id is not None:
+            self.journal.ack(message.journal_id)
+        message.close()
+        logger.warn('Queue full, deferred message from %s:%s',
+                    *message.peer[:2])
+        return '451 Requested action aborted: queue is full'
+
+    def _redeliver(self, pending):
+        try:
+            for entry, peer, mailfrom, rcpttos in pending:
+                message = MessageBuffer(peer, mailfrom, rcpttos,
+                                        self.spool_threshold, self.spool_dir)
+                # one body in memory at a time, as the queue takes them
+                message.write(self.journal.read(entry))
+                message.journal_id = entry
+                self.queue.put(message)
+        finally:
+            self._redeliverer = None
+
+    def _processed(self, message):
+        # also after process_message raised: retrying it at every restart
+        # would not fix the handler and would pin its journal segment
+        if message.journal_id is not None:
+            self.journal.ack(message.journal_id)
+
+    def _process_queued(self, message):
+        try:
+            status = self.process_message(message.peer, message.mailfrom,
+                                          message.rcpttos, message.getvalue())
+        finally:
+            message.close()
+        if status:
+            logger.warn('Queued message from %s:%s not processed: %s',
+                        message.peer[0], message.peer[1], status)
+
+    def process_message_abort(self, message):
+        """Called instead of :meth:`process_message_end` when the session
+        ends before the message is complete.
+
+        :param message: object returned by :meth:`process_message_start`
+        """
+        message.close()
+
+    def lookup_rcpts(self, addresses):
+        """Called by the channel with the RCPT addresses it has at hand,
+        :meth:`process_rcpts` through the recipient cache if there is one
+        """
+        if self.rcpt_cache is not None:
+            return self.rcpt_cache.get_many(addresses, self.process_rcpts)
+        results = self.process_rcpts(addresses)
+        if len(results) != len(addresses):
+            raise ValueError('%d results for %d addresses' %
+                             (len(results), len(addresses)))
+        return results
+
     # API that handle rcpt
+    def process_rcpts(self, addresses):
+        """Override this method to validate several recipients at once.
+
+        The channel calls it with the addresses of the RCPT commands the
+        client pipelined, instead of calling :meth:`process_rcpt` for each.
+
+        :param addresses: list of raw addresses like in :meth:`process_rcpt`
+
+        This function should return a list with a result for every address,
+        in the same order, None for a normal `250 Ok' response; otherwise
+        the desired response string in RFC 821 format.
+        """
+        return [self.process_rcpt(address) for address in addresses]
+
     def process_rcpt(self, address):
         """Override this abstract method to handle rcpt from the client
 
@@ -170,7 +698,8 @@ class DebuggingServer(SMTPServer):
     # Do something with the gathered message
     def process_message(self, peer, mailfrom, rcpttos, data):
         inheaders = 1
-        lines = data.split('\n')
+        # a spooled message comes as an mmap
+        lines = data[:].split('\n')
         print '---------- MESSAGE FOLLOWS ----------'
         for line in lines:
             # headers first
@@ -182,30 +711,113 @@ class DebuggingServer(SMTPServer):
 
 
 class PureProxy(SMTPServer):
+
+    def __init__(self, localaddr=None, remoteaddr=None, upstream=None,
+                 pool_size=10, pool_idle_timeout=60, retry_dir=None,
+                 retry_backoff=60, retry_max_backoff=3600,
+                 retry_expire=5 * 24 * 3600, retry_concurrency=2, **kwargs):
+        """Initialize the proxy
+
+        :param upstream: tuple pair of the smtpd messages are passed to,\n
+                         like `('mx.example.org', 25)`
+        :param pool_size: max connections open to one upstream
+        :param pool_idle_timeout: seconds an unused upstream connection is kept open
+        :param retry_dir: directory of the messages the upstream refused\n
+                          temporarily, they are tried again later. None drops them
+        :param retry_backoff: seconds before the first retry, doubled after\n
+                              every failed attempt
+        :param retry_max_backoff: max seconds between two attempts
+        :param retry_expire: seconds after which a message is bounced
+        :param retry_concurrency: max retries running at the same time for\n
+                                  one next hop
+        :param kwargs: other key-arguments will pass to :class:`.SMTPServer`
+        """
+        if not upstream:
+            raise ValueError('PureProxy needs an upstream address')
+        self.upstream = upstream
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        # (host, port) -> ConnectionPool
+        self.pools = {}
+        self.retry = None
+        if retry_dir:
+            self.retry = RetryQueue(retry_dir, self._deliver, self.bounce,
+                                    retry_backoff, retry_max_backoff,
+                                    retry_expire, retry_concurrency)
+        super(PureProxy, self).__init__(localaddr, remoteaddr, **kwargs)
+
+    def next_hop(self, mailfrom, rcpttos):
+        """Return the (host, port) a message is passed to"""
+        return self.upstream
+
+    def get_pool(self, host, port):
+        pool = self.pools.get((host, port))
+        if pool is None:
+            pool = self.pools[(host, port)] = ConnectionPool(
+                host, port, self.pool_size, self.pool_idle_timeout,
+                local_hostname=self.fqdn)
+        return pool
+
+    def start(self):
+        if self.retry is not None:
+            self.retry.start()
+        super(PureProxy, self).start()
+
+    def stop(self, timeout=None):
+        super(PureProxy, self).stop(timeout)
+        if self.retry is not None:
+            self.retry.stop()
+        pools, self.pools = self.pools, {}
+        for pool in pools.itervalues():
+            pool.close()
+
     def process_message(self, peer, mailfrom, rcpttos, data):
-        lines = data.split('\n')
-        # Look for the last header
-        i = 0
-        for line in lines:
-            if not line:
-                break
-            i += 1
-        lines.insert(i, 'X-Peer: %s' % peer[0])
-        data = NEWLINE.join(lines)
+        data = insert_header(data, 'X-Peer: %s' % peer[0])
         refused = self._deliver(mailfrom, rcpttos, data)
-        # TBD: what to do with refused addresses?
+        if refused:
+            self.defer(mailfrom, refused, data)
+
+    def defer(self, mailfrom, refused, data):
+        """Hand the refused recipients to the retry queue"""
         logger.debug('we got some refusals: %s', refused)
+        if self.retry is not None:
+            hop = self.next_hop(mailfrom, list(refused))
+            self.retry.add(mailfrom, refused, data, '%s:%s' % tuple(hop))
+
+    def bounce(self, deferred, data):
+        """Tell the sender that its message is given up
+
+        :param deferred: :class:`gsmtpd.retry.Deferred` of the message
+        :param data: text of the message
+        """
+        # the channel keeps the ESMTP parameters of MAIL FROM
+        sender = parseaddr(deferred.mailfrom)[1]
+        if not sender:
+            # never bounce a bounce
+            return
+        headers = data.split('\n\n', 1)[0]
+        errors = NEWLINE.join('<%s>: %s %s' % (rcpt, code, msg)
+                              for rcpt, (code, msg)
+                              in sorted(deferred.errors.iteritems()))
+        text = BOUNCE % dict(fqdn=self.fqdn, mailfrom=sender,
+                             errors=errors, headers=headers)
+        refused = self._deliver('', [sender], text)
+        if refused:
+            self.defer('', refused, text)
 
     def _deliver(self, mailfrom, rcpttos, data):
-        import smtplib
         refused = {}
+        pool = self.get_pool(*self.next_hop(mailfrom, rcpttos))
         try:
-            s = smtplib.SMTP()
-            s.connect(self._remoteaddr[0], self._remoteaddr[1])
             try:
-                refused = s.sendmail(mailfrom, rcpttos, data)
-            finally:
-                s.quit()
+                with pool.connection() as s:
+                    refused = s.sendmail(mailfrom, rcpttos, data)
+            except smtplib.SMTPServerDisconnected:
+                # the upstream may have dropped a pooled connection while
+                # it was idle, try once more on a new one
+                logger.debug('Upstream disconnected, retrying')
+                with pool.connection() as s:
+                    refused = s.sendmail(mailfrom, rcpttos, data)
         except smtplib.SMTPRecipientsRefused, e:
             logger.debug('got SMTPRecipientsRefused')
             refused = e.recipients
@@ -219,4 +831,3 @@ class PureProxy(SMTPServer):
             for r in rcpttos:
                 refused[r] = (errcode, errmsg)
         return refused
-
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Deadlines of many sessions on one timer
+
+Arming a :class:`gevent.Timeout` for every read of every session means a
+heap operation in the event loop each time.  :class:`TimerWheel` instead
+sorts the sessions into coarse time slots and a single greenlet walks
+over them, moving a deadline later is a plain attribute write.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+import gevent
+
+__all__ = ['TimerWheel', 'ConnectionTimeout']
+
+
+class ConnectionTimeout(Exception):
+    pass
+
+
+class TimerWheel(object):
+    """Fires the deadlines of many entries with one greenlet
+
+    An entry is any object with a `deadline` attribute (a :func:`time.time`
+    value or None), a `timer_slot` attribute initialised to None and an
+    `expire()` method.  After changing `deadline` call :meth:`schedule`;
+    when a slot comes, entries whose deadline has been pushed back are put
+    in their new slot and the others have `expire()` called.  Deadlines
+    fire up to `resolution` seconds late.
+    """
+
+    def __init__(self, resolution=0.5):
+        self.resolution = resolution
+        # slot number -> set of entries
+        self.slots = {}
+        self.fired = None
+        self._runner = None
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.slots.itervalues())
+
+    def schedule(self, entry):
+        """Make sure `entry` is looked at no later than its deadline"""
+        slot = int(entry.deadline / self.resolution) + 1
+        if self.fired is not None and slot <= self.fired:
+            slot = self.fired + 1
+        current = entry.timer_slot
+        if current is not None:
+            if current <= slot:
+                # it will be moved on when that slot fires
+                return
+            self._discard(entry)
+        entry.timer_slot = slot
+        bucket = self.slots.get(slot)
+        if bucket is None:
+            bucket = self.slots[slot] = set()
+        bucket.add(entry)
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+
+    def cancel(self, entry):
+        if entry.timer_slot is not None:
+            self._discard(entry)
+            entry.timer_slot = None
+
+    def _discard(self, entry):
+        bucket = self.slots.get(entry.timer_slot)
+        if bucket is not None:
+            bucket.discard(entry)
+            if not bucket:
+                del self.slots[entry.timer_slot]
+
+    def _run(self):
+        try:
+            while self.slots:
+                gevent.sleep(self.resolution)
+                self.expire(time.time())
+        finally:
+            self._runner = None
+
+    def expire(self, now):
+        """Fire every slot up to `now`"""
+        last = int(now / self.resolution)
+        if self.fired is not None:
+            first = self.fired + 1
+        elif self.slots:
+            first = min(self.slots)
+        else:
+            first = last
+        self.fired = last
+        for slot in xrange(first, last + 1):
+            bucket = self.slots.pop(slot, None)
+            if not bucket:
+                continue
+            for entry in bucket:
+                entry.timer_slot = None
+                if entry.deadline is None:
+                    continue
+                if entry.deadline > now:
+                    self.schedule(entry)
+                    continue
+                try:
+                    entry.expire()
+                except Exception as err:
+                    logger.error(err, exc_info=True)
+
+    def stop(self):
+        if self._runner is not None:
+            self._runner.kill(block=False)
+            self._runner = None
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+De-transparency of message data
+
+Lines ending with ``<CR><LF>`` become lines ending with ``\\n`` and the
+leading dot added by the client is removed, see RFC 5321, Section 4.5.2.
+Both are done with :meth:`str.split` and :meth:`str.join` over the whole
+chunk instead of looping over the lines in Python, on CPython 2.7 a split
+and a join of ``<CR><LF>`` cost half of a :meth:`str.replace`.
+"""
+
+__all__ = ['unstuff', 'Unstuffer']
+
+CRLF = '\r\n'
+CRLFDOT = '\r\n.'
+NEWLINE = '\n'
+EMPTYSTRING = ''
+
+
+def _newlines(data):
+    return NEWLINE.join(data.split(CRLF))
+
+
+def _undot(data):
+    # most chunks have no stuffed line and come back from split untouched
+    pieces = data.split(CRLFDOT)
+    if len(pieces) > 1:
+        data = CRLF.join(pieces)
+    return NEWLINE.join(data.split(CRLF))
+
+
+def unstuff(data):
+    """De-transparency a complete message
+
+    :param data: message text as received, without the final ``<CR><LF>.<CR><LF>``
+    """
+    if data[:1] == '.':
+        data = data[1:]
+    return _undot(data)
+
+
+class Unstuffer(object):
+    """De-transparency a message that arrives in chunks split anywhere
+
+    Call :meth:`feed` for every chunk and :meth:`flush` once the end of
+    data has been seen.  At most a trailing ``<CR>`` is held back between
+    chunks because it may be the first half of a line ending.
+
+    Data sent with BDAT is not dot-stuffed, pass ``dots=False`` to only
+    convert the line endings.
+    """
+
+    def __init__(self, dots=True):
+        self.dots = dots
+        self.tail = EMPTYSTRING
+        # the next byte starts a new line
+        self.bol = True
+
+    def feed(self, data):
+        if self.tail:
+            data = self.tail + data
+            self.tail = EMPTYSTRING
+        if data[-1:] == '\r':
+            self.tail = '\r'
+            data = data[:-1]
+        if not self.dots:
+            return _newlines(data)
+        if not data:
+            return data
+        if self.bol and data[0] == '.':
+            data = data[1:]
+        self.bol = data[-2:] == CRLF
+        return _undot(data)
+
+    def flush(self):
+        data, self.tail = self.tail, EMPTYSTRING
+        self.bol = True
+        return data
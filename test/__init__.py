@@ -3,3 +3,15 @@
 
 from .test_server import *
 from .test_extend_api import *
+from .test_buffer import *
+from .test_transcode import *
+from .test_channel import *
+from .test_prefork import *
+from .test_timer import *
+from .test_handoff import *
+from .test_journal import *
+from .test_pool import *
+from .test_retry import *
+from .test_acl import *
+from .test_cache import *
+from .test_metrics import *
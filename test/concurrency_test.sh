@@ -1,5 +0,0 @@
-#!/bin/bash
-
-for $i in {1..10000..1000}
-do
-    python 
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import smtplib
+import tempfile
+
+from .greentest import TestCase
+from .utils import run
+from gsmtpd.acl import ACL
+from gsmtpd.server import SMTPServer
+
+__all__ = ['ACLTestCase', 'ACLServerTestCase']
+
+
+class ACLTestCase(TestCase):
+
+    def test_longest_prefix(self):
+        acl = ACL(allow=['10.0.0.0/8', '10.1.2.3'], deny=['10.1.0.0/16'])
+        self.assertIn('10.2.3.4', acl)
+        self.assertNotIn('10.1.2.4', acl)
+        self.assertIn('10.1.2.3', acl)
+        self.assertNotIn('192.168.1.1', acl)
+        self.assertEqual(acl.lookup('192.168.1.1'), None)
+
+    def test_ipv6(self):
+        acl = ACL(allow=['2001:db8::/32'], deny=['2001:db8:dead::/48'])
+        self.assertIn('2001:db8:1::1', acl)
+        self.assertNotIn('2001:db8:dead::1', acl)
+        self.assertNotIn('::1', acl)
+
+    def test_mapped(self):
+        acl = ACL(allow=['127.0.0.0/8'])
+        self.assertIn('::ffff:127.0.0.1', acl)
+
+    def test_default(self):
+        acl = ACL(deny=['0.0.0.0/0'], default=True)
+        self.assertNotIn('1.2.3.4', acl)
+        self.assertIn('::1', acl)
+        self.assertIn('not an address', acl)
+
+    def test_host_bits(self):
+        self.assertIn('192.168.1.200', ACL(allow=['192.168.1.77/24']))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ACL, ['10.0.0.0/33'])
+        self.assertRaises(ValueError, ACL, ['example.org'])
+
+    def test_reload(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('# relays\n10.0.0.0/8\ndeny 10.9.0.0/16  # lab\n')
+            acl = ACL(path=path)
+            self.assertEqual(len(acl), 2)
+            self.assertNotIn('10.9.1.1', acl)
+            with open(path, 'w') as f:
+                f.write('allow 10.9.0.0/16\n')
+            acl.reload()
+            self.assertIn('10.9.1.1', acl)
+            self.assertNotIn('10.1.1.1', acl)
+        finally:
+            os.remove(path)
+
+
+class ACLServerTestCase(TestCase):
+
+    def connect(self, remoteaddr):
+        server = SMTPServer(('127.0.0.1', 0), remoteaddr)
+        server.start()
+        sm = smtplib.SMTP()
+        try:
+            return run(sm.connect, '127.0.0.1', server.server_port)[0]
+        except smtplib.SMTPServerDisconnected:
+            return None
+        finally:
+            sm.close()
+            server.stop()
+
+    def test_allowed(self):
+        self.assertEqual(self.connect('127.0.0.0/8'), 220)
+        self.assertEqual(self.connect(['10.0.0.0/8', '127.0.0.1']), 220)
+
+    def test_refused(self):
+        self.assertEqual(self.connect('10.0.0.0/8'), None)
+        self.assertEqual(self.connect(ACL(deny=['127.0.0.1'], default=True)), None)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from asynchat import find_prefix_at_end
+
+from .greentest import TestCase
+from gsmtpd.buffer import ReceiveBuffer
+
+__all__ = ['ReceiveBufferTestCase']
+
+
+class FakeConn(object):
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view, size):
+        data = self.chunks.pop(0)[:size]
+        view[:len(data)] = data
+        return len(data)
+
+
+class ReceiveBufferTestCase(TestCase):
+
+    def test_recv_into(self):
+        buf = ReceiveBuffer(16)
+        conn = FakeConn('HELO a\r\n', '')
+        self.assertEqual(buf.recv_into(conn, 8), 8)
+        self.assertEqual(buf.peek().tobytes(), 'HELO a\r\n')
+        self.assertEqual(buf.recv_into(conn, 8), 0)
+        self.assertEqual(len(buf), 8)
+
+    def test_find_and_take(self):
+        buf = ReceiveBuffer(16)
+        buf.feed('NOOP\r\nQUIT\r\n')
+        index = buf.find('\r\n')
+        self.assertEqual(index, 4)
+        self.assertEqual(buf.take(index).tobytes(), 'NOOP')
+        buf.consume(2)
+        self.assertEqual(buf.find('\r\n'), 4)
+        self.assertEqual(buf.take().tobytes(), 'QUIT\r\n')
+        self.assertFalse(buf)
+
+    def test_incremental_find(self):
+        buf = ReceiveBuffer(8)
+        for chunk in ['hello', ' wor', 'ld\r', '\nrest']:
+            index = buf.find('\r\n')
+            buf.feed(chunk)
+        self.assertEqual(index, -1)
+        self.assertEqual(buf.find('\r\n'), 11)
+        self.assertEqual(buf.find('\r\n.\r\n'), -1)
+
+    def test_grow_and_shrink(self):
+        buf = ReceiveBuffer(8)
+        buf.feed('x' * 20)
+        self.assertTrue(buf.capacity >= 20)
+        view = buf.take(10)
+        buf.feed('y' * 4)
+        self.assertEqual(view.tobytes(), 'x' * 10)
+        buf.take()
+        buf.feed('z')
+        self.assertEqual(buf.capacity, 8)
+        self.assertEqual(buf.peek().tobytes(), 'z')
+
+    def test_compact(self):
+        buf = ReceiveBuffer(8)
+        buf.feed('abcdef')
+        buf.consume(4)
+        buf.feed('ghijkl')
+        self.assertEqual(buf.capacity, 8)
+        self.assertEqual(buf.peek().tobytes(), 'efghijkl')
+        self.assertEqual(buf.find('kl'), 6)
+
+    def test_prefix_at_end(self):
+        terminator = '\r\n.\r\n'
+        for data in ['abc', 'abc\r', 'abc\r\n', 'abc\r\n.', 'abc\r\n.\r', '\r']:
+            buf = ReceiveBuffer(8)
+            buf.feed('xx' + data)
+            buf.consume(2)
+            self.assertEqual(buf.prefix_at_end(terminator),
+                             find_prefix_at_end(data, terminator))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import smtplib
+
+import gevent
+
+from .greentest import TestCase
+from .utils import connect, run
+from gsmtpd.cache import RcptCache
+from gsmtpd.server import SMTPServer
+
+__all__ = ['RcptCacheTestCase', 'RcptCacheServerTestCase']
+
+
+class RcptCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.cache = RcptCache(self.lookup, size=2, ttl=0.1, negative_ttl=0.05)
+
+    def lookup(self, address):
+        self.calls.append(address)
+        gevent.sleep(0.01)
+        if address.startswith('busy'):
+            return '451 try again'
+        if address.startswith('error'):
+            raise IOError('directory is down')
+        if not address.startswith('ok'):
+            return '550 no such user'
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get('ok@a'), None)
+        self.assertEqual(self.cache.get('ok@a'), None)
+        self.assertEqual(self.calls, ['ok@a'])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_negative_ttl(self):
+        self.assertEqual(self.cache.get('no@a'), '550 no such user')
+        self.cache.get('ok@a')
+        gevent.sleep(0.06)
+        self.cache.get('no@a')
+        self.cache.get('ok@a')
+        self.assertEqual(self.calls, ['no@a', 'ok@a', 'no@a'])
+
+    def test_temporary(self):
+        self.cache.get('busy@a')
+        self.cache.get('busy@a')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_lru(self):
+        for address in ('ok@a', 'ok@b', 'ok@a', 'ok@c', 'ok@a', 'ok@b'):
+            self.cache.get(address)
+        self.assertEqual(self.calls, ['ok@a', 'ok@b', 'ok@c', 'ok@b'])
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+
+    def test_coalesce(self):
+        results = gevent.joinall([gevent.spawn(self.cache.get, 'no@a')
+                                  for _ in xrange(10)])
+        self.assertEqual(self.calls, ['no@a'])
+        self.assertEqual(set(g.value for g in results), set(['550 no such user']))
+        self.assertEqual(self.cache.stats()['coalesced'], 9)
+
+    def test_get_many(self):
+        batches = []
+
+        def lookup(addresses):
+            batches.append(addresses)
+            return [self.lookup(address) for address in addresses]
+        self.cache.get('ok@a')
+        waiter = gevent.spawn(self.cache.get, 'ok@b')
+        gevent.sleep(0)
+        self.assertEqual(self.cache.get_many(['ok@a', 'ok@b', 'no@c', 'no@c'],
+                                             lookup),
+                         [None, None, '550 no such user', '550 no such user'])
+        self.assertEqual(batches, [['no@c']])
+        self.assertEqual(waiter.get(), None)
+        self.assertEqual(self.cache.stats()['coalesced'], 2)
+
+    def test_error(self):
+        def get(address):
+            try:
+                return self.cache.get(address)
+            except IOError as err:
+                return err
+        waiters = [gevent.spawn(get, 'error@a') for _ in xrange(3)]
+        gevent.joinall(waiters)
+        self.assertTrue(all(isinstance(g.value, IOError) for g in waiters))
+        self.assertEqual(self.calls, ['error@a'])
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.pending, {})
+
+    def test_wrong_count(self):
+        waiter = gevent.spawn(self.cache.get, 'ok@b')
+        gevent.sleep(0)
+        self.assertRaises(ValueError, self.cache.get_many,
+                          ['ok@a', 'ok@b', 'ok@c'], lambda addresses: [None])
+        self.assertEqual(waiter.get(), None)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.pending, {})
+
+    def test_killed(self):
+        lookup = gevent.spawn(self.cache.get, 'ok@a')
+        gevent.sleep(0)
+        waiter = gevent.spawn(lambda: self.assertRaises(LookupError,
+                                                        self.cache.get, 'ok@a'))
+        gevent.sleep(0)
+        lookup.kill()
+        waiter.get()
+        self.assertEqual(self.cache.pending, {})
+
+
+
+class CountingServer(SMTPServer):
+
+    def process_rcpt(self, address):
+        self.calls += 1
+        if address != 'test@gsmtp.org':
+            return '550 No such user'
+
+
+class RcptCacheServerTestCase(TestCase):
+
+    def setUp(self):
+        self.server = CountingServer(('127.0.0.1', 0), rcpt_cache=100)
+        self.server.calls = 0
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.sm.close()
+        self.server.stop()
+
+    @connect
+    def test_cached(self):
+        run(self.sm.helo)
+        for _ in xrange(3):
+            run(self.sm.mail, 'test@gsmtpd.org')
+            self.assertEqual(run(self.sm.rcpt, 'test@gsmtp.org')[0], 250)
+            self.assertEqual(run(self.sm.rcpt, 'nobody@gsmtp.org')[0], 550)
+            run(self.sm.rset)
+        self.assertEqual(self.server.calls, 2)
+        self.assertEqual(self.server.stats()['rcpt_cache']['hits'], 4)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+from .greentest import TestCase
+from .utils import FakeSocket
+from gsmtpd.channel import SMTPChannel
+from gsmtpd.server import SMTPServer
+
+__all__ = ['ChannelTestCase']
+
+
+class MemoryServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class ChannelTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = MemoryServer(('127.0.0.1', 0), hostname='mx.gsmtpd.org')
+        self.server.messages = []
+
+    def channel(self, *chunks, **kwargs):
+        conn = FakeSocket(*chunks)
+        channel_class = kwargs.get('channel_class', SMTPChannel)
+        sc = channel_class(self.server, conn, conn.getpeername(),
+                           self.server.data_size_limit)
+        while not sc.closed:
+            sc.handle_read()
+        return conn
+
+    def test_banner(self):
+        conn = self.channel()
+        self.assertEqual(conn.sent[0], '220 mx.gsmtpd.org GSMTPD at your service\r\n')
+        self.assertTrue(conn.closed)
+
+    def test_coalesced_reply(self):
+        conn = self.channel('EHLO client.example\r\n')
+        ehlo = conn.sent[1]
+        self.assertTrue(ehlo.startswith('250-mx.gsmtpd.org on plain\r\n'))
+        self.assertTrue(ehlo.endswith('250 HELP\r\n'))
+        self.assertEqual(len(conn.sent), 2)
+
+    def test_reply_before_close(self):
+        conn = self.channel('QUIT\r\n')
+        self.assertEqual(conn.sent[-1], '221 Bye\r\n')
+
+    def test_pipelining(self):
+        conn = self.channel('EHLO client.example\r\n',
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'RCPT TO:<c@example.com>\r\n'
+                            'DATA\r\n',
+                            'hello\r\n.\r\nQUIT\r\n')
+        self.assertTrue('250-PIPELINING\r\n' in conn.sent[1])
+        self.assertEqual(conn.sent[2], '250 Ok\r\n' * 3 +
+                         '354 End data with <CR><LF>.<CR><LF>\r\n')
+        self.assertEqual(conn.sent[3], '250 Ok\r\n221 Bye\r\n')
+        self.assertEqual(self.server.messages,
+                         [('a@example.com', ['b@example.com', 'c@example.com'],
+                           'hello')])
+
+    def test_timer_cancelled(self):
+        for _ in xrange(3):
+            self.channel('EHLO client.example\r\nQUIT\r\n')
+        self.assertEqual(len(self.server.timers), 0)
+
+    def test_nothing_after_quit(self):
+        conn = self.channel('NOOP\r\nQUIT\r\nNOOP\r\n')
+        self.assertEqual(conn.sent[1:], ['250 Ok\r\n221 Bye\r\n'])
+
+    def test_bdat(self):
+        conn = self.channel('HELO client.example\r\n',
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'BDAT 9\r\nline',
+                            ' one\rBDAT 12 LAST\r\n\n.line two\r\n',
+                            'QUIT\r\n')
+        self.assertEqual(conn.sent[2], '250 Ok\r\n250 Ok\r\n')
+        self.assertEqual(conn.sent[3], '250 Ok: 9 octets received\r\n'
+                                       '250 Ok\r\n')
+        self.assertEqual(self.server.messages,
+                         [('a@example.com', ['b@example.com'],
+                           'line one\n.line two\n')])
+
+    def test_bdat_empty_last(self):
+        self.channel('HELO client.example\r\n'
+                     'MAIL FROM:<a@example.com>\r\n'
+                     'RCPT TO:<b@example.com>\r\n'
+                     'BDAT 5\r\nabc\r\n'
+                     'BDAT 0 LAST\r\n'
+                     'QUIT\r\n')
+        self.assertEqual(self.server.messages,
+                         [('a@example.com', ['b@example.com'], 'abc\n')])
+
+    def test_binarymime(self):
+        conn = self.channel('HELO client.example\r\n'
+                            'MAIL FROM:<a@example.com> BODY=BINARYMIME\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'DATA\r\n'
+                            'BDAT 6 LAST\r\n\x00\r\n.\r\n'
+                            'QUIT\r\n')
+        self.assertTrue('503 Error: message must be sent with BDAT\r\n'
+                        in conn.sent[1])
+        self.assertEqual(self.server.messages[0][2], '\x00\r\n.\r\n')
+
+    def test_bdat_errors(self):
+        self.server.data_size_limit = 100
+        conn = self.channel('HELO client.example\r\n'
+                            'BDAT 4\r\nQUIT'
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'BDAT 4\r\nabcd'
+                            'BDAT 97 LAST\r\n' + 'x' * 97 +
+                            'BDAT x\r\n'
+                            'QUIT\r\n')
+        self.assertEqual(conn.sent[1].split('\r\n')[1:-1],
+                         ['503 Error: need RCPT command', '250 Ok', '250 Ok',
+                          '250 Ok: 4 octets received',
+                          '552 Error: message too big',
+                          '501 Syntax: BDAT chunk-size [LAST]', '221 Bye'])
+        self.assertEqual(self.server.messages, [])
+
+    def test_starttls_aborts_bdat(self):
+        events = []
+        self.server.wrap_ssl = lambda conn: conn
+        self.server.process_message_abort = lambda message: \
+            events.append('abort')
+        self.server.on_command = lambda sc, command, arg, started, duration: \
+            events.append(command)
+        conn = self.channel('EHLO client.example\r\n'
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'BDAT 5\r\nhello',
+                            'STARTTLS\r\n',
+                            'EHLO client.example\r\n'
+                            'BDAT 5 LAST\r\nworld')
+        self.assertEqual(events, ['EHLO', 'MAIL', 'RCPT', 'BDAT', 'abort',
+                                  'STARTTLS', 'EHLO', 'BDAT'])
+        self.assertEqual(conn.sent[-2], '220 Ready to start TLS\r\n')
+        self.assertTrue(conn.sent[-1].endswith(
+            '503 Error: need RCPT command\r\n'))
+        self.assertEqual(self.server.messages, [])
+
+    def test_batched_rcpt(self):
+        batches = []
+
+        def process_rcpts(addresses):
+            batches.append(addresses)
+            return [None if address.startswith('b') else '550 No such user'
+                    for address in addresses]
+        self.server.process_rcpts = process_rcpts
+        conn = self.channel('HELO client.example\r\n',
+                            'RCPT TO:<b@example.com>\r\n'
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'RCPT TO:<x@example.com>\r\n'
+                            'RCPT TO:<b2@example.com>\r\n'
+                            'NOOP\r\n'
+                            'RCPT TO:<b3@example.com>\r\n',
+                            'DATA\r\nhello\r\n.\r\nQUIT\r\n')
+        self.assertEqual(batches, [['b@example.com', 'x@example.com',
+                                    'b2@example.com'], ['b3@example.com']])
+        self.assertEqual(conn.sent[2].split('\r\n')[:-1],
+                         ['503 Error: need MAIL command', '250 Ok', '250 Ok',
+                          '550 No such user', '250 Ok', '250 Ok', '250 Ok'])
+        self.assertEqual(self.server.messages[0][1],
+                         ['b@example.com', 'b2@example.com', 'b3@example.com'])
+
+    def test_rcpts_wrong_count(self):
+        self.server.process_rcpts = lambda addresses: [None]
+        conn = self.channel('HELO client.example\r\n',
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n'
+                            'RCPT TO:<c@example.com>\r\n'
+                            'DATA\r\n',
+                            'QUIT\r\n')
+        error = '451 Requested action aborted: local error in processing'
+        self.assertEqual(conn.sent[2].split('\r\n')[:-1],
+                         ['250 Ok', error, error,
+                          '503 Error: need RCPT command'])
+        self.assertEqual(conn.sent[3], '221 Bye\r\n')
+
+    def test_dispatch_table(self):
+
+        class Channel(SMTPChannel):
+
+            def smtp_NOOP(self, arg):
+                self.push('250 Noop %s' % arg)
+
+            def smtp_XPING(self, arg):
+                self.push('250 Pong')
+
+        Channel.register_command('xecho', lambda channel, arg:
+                                 channel.push('250 %s' % arg))
+        conn = self.channel('noop\r\nXPING\r\nXECHO hi\r\nTIMEOUT\r\n'
+                            'QUIT\r\n', channel_class=Channel)
+        self.assertEqual(conn.sent[1].split('\r\n')[:-1],
+                         ['250 Noop None', '250 Pong', '250 hi',
+                          '502 Error: command "TIMEOUT" not implemented',
+                          '221 Bye'])
+        self.assertFalse('XPING' in SMTPChannel.commands())
+        self.assertFalse('XECHO' in SMTPChannel.commands())
+        conn = self.channel('XECHO hi\r\nQUIT\r\n')
+        self.assertEqual(conn.sent[1],
+                         '502 Error: command "XECHO" not implemented\r\n'
+                         '221 Bye\r\n')
+
+    def test_line_too_long(self):
+        line = 'HELO ' + 'x' * 505
+        conn = self.channel(line + '\r\n',
+                            line[:300], line[300:] + 'x\r\nQUIT\r\n')
+        self.assertEqual(conn.sent[1:], ['250 mx.gsmtpd.org\r\n',
+                                         '500 Error: line too long\r\n'
+                                         '221 Bye\r\n'])
+
+    def test_mail_line_length(self):
+        mail = 'MAIL FROM:<%s@example.com> SIZE=1000 BODY=BINARYMIME' % (
+            'a' * 480)
+        self.assertEqual(len(mail), 530)
+        conn = self.channel('EHLO client.example\r\n',
+                            mail + '\r\n',
+                            'RCPT TO:<%s@example.com>\r\n' % ('b' * 500),
+                            'QUIT\r\n')
+        self.assertEqual(conn.sent[2:], ['250 Ok\r\n',
+                                         '500 Error: line too long\r\n',
+                                         '221 Bye\r\n'])
+
+    def test_hooks(self):
+        events = []
+        self.server.on_connect = lambda sc, ts: events.append(('connect',))
+        self.server.on_command = lambda sc, command, arg, started, duration: \
+            events.append(('command', command, arg, duration >= 0))
+        self.server.on_data_start = lambda sc, ts: events.append(('data',))
+        self.server.on_data_end = lambda sc, ts, size: \
+            events.append(('data_end', size))
+        self.server.on_message_processed = \
+            lambda sc, started, duration, status: \
+            events.append(('processed', sc.rcpttos, status))
+        self.server.on_close = lambda sc, ts: \
+            events.append(('close', sc.received, sc.sent))
+        conn = self.channel('HELO client.example\r\n'
+                            'MAIL FROM:<a@example.com>\r\n'
+                            'RCPT TO:<b@example.com>\r\n',
+                            'DATA\r\nhello\r\n.\r\nQUIT\r\n')
+        self.assertEqual(events, [
+            ('connect',),
+            ('command', 'HELO', 'client.example', True),
+            ('command', 'MAIL', 'FROM:<a@example.com>', True),
+            ('command', 'RCPT', 'TO:<b@example.com>', True),
+            ('data',),
+            ('command', 'DATA', None, True),
+            ('data_end', 5),
+            ('processed', ['b@example.com'], None),
+            ('command', 'QUIT', None, True),
+            ('close', 95, len(''.join(conn.sent)))])
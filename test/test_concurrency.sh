@@ -1,7 +1,9 @@
 #!/bin/bash
+# sweeps the concurrent sessions against a server listening on port 5001
 
+cd "$(dirname "$0")/.."
 for i in {500..10000..500}
 do
     echo $i
-    python concurrency.py 5001 $i >> async.log
+    python -m benchmark.loadgen --port 5001 --sessions $i >> async.log
 done
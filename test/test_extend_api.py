@@ -5,12 +5,14 @@ from gevent import monkey
 monkey.patch_all()
 
 import smtplib
+import gevent
 
 from .greentest import TestCase
 from .utils import connect, run
 from gsmtpd.server import SMTPServer
 
-__all__ = ['ProcessRCPTServerTestCase', 'RCPTAPITestCase']
+__all__ = ['ProcessRCPTServerTestCase', 'RCPTAPITestCase',
+           'StreamingServerTestCase']
 
 class ProcessRCPTServer(SMTPServer):
 
@@ -56,3 +58,49 @@ class RCPTAPITestCase(TestCase):
         run(self.sm.helo)
         run(self.sm.mail, 'test@gsmtpd.org')
         self.assertEqual(run(self.sm.rcpt, 'test@gsmtp.org')[0], 250)
+
+
+class StreamingServer(SMTPServer):
+
+    def process_message_start(self, peer, mailfrom, rcpttos):
+        self.chunks = []
+        self.aborted = False
+        return self.chunks
+
+    def process_message_chunk(self, message, data):
+        message.append(data)
+
+    def process_message_end(self, message):
+        self.data = ''.join(message)
+        return '250 Ok: %d chunks' % len(message)
+
+    def process_message_abort(self, message):
+        self.aborted = True
+
+class StreamingServerTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = StreamingServer(('127.0.0.1', 0))
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    @connect
+    def test_chunks(self):
+        lines = ['.line %d' % i for i in xrange(2000)]
+        run(self.sm.sendmail, 'test@gsmtpd.org', ['test@gsmtp.org'],
+            '\r\n'.join(lines))
+        # smtplib dot-stuffs the lines, the server must undo it
+        self.assertTrue(self.server.data == '\n'.join(lines))
+        self.assertTrue(len(self.server.chunks) > 1)
+
+    @connect
+    def test_abort(self):
+        run(self.sm.helo)
+        run(self.sm.mail, 'test@gsmtpd.org')
+        run(self.sm.rcpt, 'test@gsmtp.org')
+        run(self.sm.docmd, 'DATA')
+        self.sm.send('partial line')
+        self.sm.close()
+        gevent.sleep(0.05)
+        self.assertTrue(self.server.aborted)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import smtplib
+import gevent
+from gevent.event import Event
+
+from .greentest import TestCase
+from .utils import connect, run
+from gsmtpd.server import SMTPServer
+from gsmtpd.handoff import MessageQueue
+
+__all__ = ['MessageQueueTestCase', 'QueueServerTestCase']
+
+
+class MessageQueueTestCase(TestCase):
+
+    def test_workers(self):
+        done = []
+        queue = MessageQueue(done.append, maxsize=10, workers=2)
+        queue.start()
+        for i in xrange(5):
+            self.assertTrue(queue.put(i))
+        queue.stop(1)
+        self.assertEqual(sorted(done), range(5))
+        self.assertEqual(queue.stats()['processed'], 5)
+
+    def test_full(self):
+        queue = MessageQueue(None, maxsize=1, workers=1)
+        self.assertTrue(queue.put(1, 0))
+        self.assertFalse(queue.put(2, 0.01))
+        self.assertEqual(len(queue), 1)
+
+    def test_stop_full(self):
+        done = []
+        queue = MessageQueue(done.append, maxsize=2, workers=3)
+        for i in xrange(2):
+            queue.put(i)
+        queue.start()
+        with gevent.Timeout(1):
+            queue.stop()
+        self.assertEqual(done, [0, 1])
+        self.assertEqual(queue.pool, [])
+
+    def test_failure(self):
+        def handler(message):
+            raise ValueError(message)
+        done = []
+        queue = MessageQueue(handler, workers=1, done=done.append)
+        queue.start()
+        queue.put(1)
+        queue.stop(1)
+        self.assertEqual(queue.stats()['failed'], 1)
+        self.assertEqual(done, [1])
+
+    def test_threads(self):
+        done = []
+        queue = MessageQueue(done.append, workers=1, threads=True)
+        queue.start()
+        queue.put('message')
+        queue.stop(1)
+        self.assertEqual(done, ['message'])
+
+
+class QueueServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.release.wait()
+        self.messages.append(data)
+
+
+class QueueServerTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = QueueServer(('127.0.0.1', 0), timeout=0.1,
+                                  queue_size=1, queue_workers=1)
+        self.server.messages = []
+        self.server.release = Event()
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.stop()
+
+    def send(self, data):
+        run(self.sm.mail, 'test@gsmtpd.org')
+        run(self.sm.rcpt, 'test@gsmtp.org')
+        return run(self.sm.data, data)
+
+    @connect
+    def test_queued(self):
+        run(self.sm.helo)
+        self.assertEqual(self.send('first'), (250, 'Ok: queued'))
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.messages, [])
+        self.server.release.set()
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.messages, ['first'])
+        self.assertEqual(self.server.stats()['queue']['processed'], 1)
+
+    @connect
+    def test_full(self):
+        run(self.sm.helo)
+        # the worker holds the first, the queue the second
+        self.assertEqual(self.send('first')[0], 250)
+        gevent.sleep(0.01)
+        self.assertEqual(self.send('second')[0], 250)
+        self.assertEqual(self.send('third')[0], 451)
+        self.assertEqual(self.server.stats()['queue']['queued'], 1)
+        self.server.release.set()
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.messages, ['first', 'second'])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import shutil
+import smtplib
+import tempfile
+
+import gevent
+
+from .greentest import TestCase
+from .utils import connect, run
+from gsmtpd.server import SMTPServer
+from gsmtpd.journal import Journal
+
+__all__ = ['JournalTestCase', 'JournalServerTestCase']
+
+PEER = ('127.0.0.1', 2525)
+
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gsmtpd-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, **kwargs):
+        journal = Journal(self.directory, **kwargs)
+        self.assertEqual(journal.recover(), [])
+        return journal
+
+    def test_recover(self):
+        journal = self.journal()
+        first = journal.append(PEER, 'a@gsmtpd.org', ['b@gsmtpd.org'], 'first')
+        second = journal.append(PEER, 'a@gsmtpd.org', ['c@gsmtpd.org'], 'second')
+        journal.ack(first)
+        journal.close()
+
+        journal = Journal(self.directory)
+        self.assertEqual(journal.recover(),
+                         [(second, PEER, 'a@gsmtpd.org', ['c@gsmtpd.org'])])
+        self.assertEqual(journal.read(second), 'second')
+        self.assertTrue(journal.append(PEER, 'a', ['b'], 'third') > second)
+        journal.close()
+
+    def test_group_commit(self):
+        journal = self.journal(commit_window=0.01)
+        entries = gevent.joinall([gevent.spawn(journal.append, PEER, 'a', ['b'], 'data')
+                                  for _ in xrange(50)])
+        self.assertEqual(len(set(g.value for g in entries)), 50)
+        self.assertEqual(journal.commits, 1)
+        journal.close()
+
+    def test_torn_record(self):
+        journal = self.journal()
+        entry = journal.append(PEER, 'a', ['b'], 'complete')
+        journal.append(PEER, 'a', ['b'], 'torn message')
+        path = journal.current.path
+        journal.close()
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        journal = Journal(self.directory)
+        self.assertEqual([p[0] for p in journal.recover()], [entry])
+        journal.close()
+
+    def test_large_record(self):
+        journal = self.journal()
+        data = ''.join(chr(i % 251) for i in xrange(200 * 1024))
+        entry = journal.append(PEER, 'a', ['b'], data)
+        path = journal.current.path
+        journal.close()
+
+        journal = Journal(self.directory)
+        self.assertEqual([p[0] for p in journal.recover()], [entry])
+        self.assertEqual(journal.read(entry), data)
+        journal.close()
+
+        # a flipped byte in the middle of the data is caught
+        with open(path, 'r+b') as f:
+            f.seek(100 * 1024)
+            byte = f.read(1)
+            f.seek(100 * 1024)
+            f.write(chr(ord(byte) ^ 1))
+        journal = Journal(self.directory)
+        self.assertEqual(journal.recover(), [])
+        journal.close()
+
+    def test_segments(self):
+        journal = self.journal(segment_size=100)
+        entries = [journal.append(PEER, 'a', ['b'], 'x' * 100)
+                   for _ in xrange(3)]
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        for entry in entries:
+            journal.ack(entry)
+        journal.sync()
+        self.assertEqual(len(journal), 0)
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(journal.current.path)])
+        journal.close()
+
+
+class JournalServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.crash:
+            # the process dies before the message is processed
+            gevent.sleep(60)
+        if data == 'invalid':
+            raise ValueError(data)
+        self.messages.append(data)
+
+
+class JournalServerTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gsmtpd-test-')
+        self.server = self.start(crash=True)
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def start(self, crash):
+        server = JournalServer(('127.0.0.1', 0), journal_dir=self.directory,
+                               queue_workers=1)
+        server.crash = crash
+        server.messages = []
+        server.start()
+        return server
+
+    @connect
+    def test_redeliver(self):
+        run(self.sm.helo)
+        self.assertEqual(run(self.sm.sendmail, 'test@gsmtpd.org',
+                             ['test@gsmtp.org'], 'journaled'), {})
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.stats()['journal']['pending'], 1)
+        self.server.stop(0.01)
+
+        self.server = self.start(crash=False)
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.messages, ['journaled'])
+        self.assertEqual(self.server.stats()['journal']['pending'], 0)
+
+    @connect
+    def test_failed(self):
+        self.server.crash = False
+        run(self.sm.helo)
+        self.assertEqual(run(self.sm.sendmail, 'test@gsmtpd.org',
+                             ['test@gsmtp.org'], 'invalid'), {})
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.stats()['journal']['pending'], 0)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import smtplib
+import urllib2
+
+from .greentest import TestCase
+from .utils import connect, run
+from gsmtpd.metrics import Metrics, Counter, Histogram
+from gsmtpd.server import SMTPServer
+
+__all__ = ['MetricsTestCase', 'MetricsServerTestCase']
+
+
+class MetricsTestCase(TestCase):
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test', ('command', 'reply'))
+        counter.inc(('MAIL', '2xx'))
+        counter.inc(('MAIL', '2xx'), 2)
+        counter.inc(('RCPT', '5"x'))
+        self.assertEqual(counter.get(('MAIL', '2xx')), 3)
+        self.assertEqual(list(counter.samples()),
+                         [('test_total{command="MAIL",reply="2xx"}', 3),
+                          ('test_total{command="RCPT",reply="5\\"x"}', 1)])
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(list(histogram.samples()),
+                         [('test_seconds_bucket{le="0.1"}', 2),
+                          ('test_seconds_bucket{le="1"}', 3),
+                          ('test_seconds_bucket{le="+Inf"}', 4),
+                          ('test_seconds_sum', 2.65),
+                          ('test_seconds_count', 4)])
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.sessions.inc()
+        text = metrics.render(dict(sessions=2, queue=dict(busy=1), name='x'))
+        self.assertTrue('# TYPE gsmtpd_sessions_total counter\n'
+                        'gsmtpd_sessions_total 1\n' in text)
+        self.assertTrue('# TYPE gsmtpd_command_seconds histogram\n' in text)
+        self.assertTrue('gsmtpd_sessions 2\n' in text)
+        self.assertTrue('gsmtpd_queue_busy 1\n' in text)
+        self.assertFalse('gsmtpd_name' in text)
+
+    def test_disabled(self):
+        server = NullServer(('127.0.0.1', 0))
+        self.assertEqual(server.metrics, None)
+
+
+class NullServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+
+class MetricsServerTestCase(TestCase):
+
+    def setUp(self):
+        self.server = NullServer(('127.0.0.1', 0),
+                                 metrics_localaddr=('127.0.0.1', 0))
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.sm.close()
+        self.server.stop()
+
+    @connect
+    def test_session(self):
+        run(self.sm.sendmail, 'a@gsmtpd.org', ['b@gsmtpd.org'], 'hello')
+        run(self.sm.docmd, 'XYZZY')
+        run(self.sm.quit)
+        metrics = self.server.metrics
+        self.assertEqual(metrics.sessions.get(), 1)
+        self.assertEqual(metrics.replies.get(('CONNECT', '2xx')), 1)
+        self.assertEqual(metrics.replies.get(('RCPT', '2xx')), 1)
+        self.assertEqual(metrics.replies.get(('DATA', '3xx')), 1)
+        self.assertEqual(metrics.replies.get(('DATA', '2xx')), 1)
+        self.assertEqual(metrics.replies.get(('UNKNOWN', '5xx')), 1)
+        self.assertEqual(metrics.commands.count(('MAIL',)), 1)
+        self.assertEqual(metrics.banner.count(), 1)
+        self.assertEqual(metrics.data.count(), 1)
+        self.assertEqual(metrics.processing.count(), 1)
+        self.assertTrue(metrics.bytes.get(('in',)) > 0)
+        self.assertTrue(metrics.bytes.get(('out',)) > 0)
+
+        url = 'http://127.0.0.1:%d/metrics' % \
+            self.server.metrics_server.server_port
+        text = run(lambda: urllib2.urlopen(url).read())
+        self.assertTrue('gsmtpd_sessions_total 1\n' in text)
+        self.assertTrue('gsmtpd_command_seconds_count{command="MAIL"} 1\n'
+                        in text)
+        self.assertTrue('gsmtpd_sessions ' in text)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import smtplib
+
+import gevent
+
+from .greentest import TestCase
+from .utils import connect, run
+from gsmtpd.server import SMTPServer, PureProxy
+from gsmtpd.pool import ConnectionPool
+
+__all__ = ['ConnectionPoolTestCase', 'PureProxyTestCase']
+
+
+class UpstreamServer(SMTPServer):
+
+    def handle(self, sock, addr):
+        self.connections += 1
+        super(UpstreamServer, self).handle(sock, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def process_rcpt(self, address):
+        if address.startswith('nobody'):
+            return '550 No such user'
+
+
+def upstream():
+    server = UpstreamServer(('127.0.0.1', 0))
+    server.connections = 0
+    server.messages = []
+    server.start()
+    return server
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.upstream = upstream()
+        self.pool = ConnectionPool('127.0.0.1', self.upstream.server_port,
+                                   size=2, idle_timeout=0.2, check_after=0.05)
+
+    def tearDown(self):
+        self.pool.close()
+        self.upstream.stop()
+
+    def send(self, rcpt='test@gsmtp.org'):
+        with self.pool.connection() as conn:
+            return conn.sendmail('test@gsmtpd.org', [rcpt], 'data')
+
+    def test_reuse(self):
+        for _ in xrange(3):
+            self.send()
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(len(self.upstream.messages), 3)
+        self.assertEqual(self.pool.stats()['reused'], 2)
+
+    def test_bounded(self):
+        gevent.joinall([gevent.spawn(self.send) for _ in xrange(5)])
+        self.assertEqual(len(self.upstream.messages), 5)
+        self.assertEqual(self.upstream.connections, 2)
+
+    def test_reset_after_refusal(self):
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+                          self.send, 'nobody@gsmtp.org')
+        self.send()
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(len(self.upstream.messages), 1)
+
+    def test_health_check(self):
+        self.send()
+        self.pool.idle[0][0].sock.close()
+        gevent.sleep(0.1)
+        self.send()
+        self.assertEqual(self.upstream.connections, 2)
+        self.assertEqual(self.pool.stats()['evicted'], 1)
+
+    def test_idle_eviction(self):
+        self.send()
+        self.assertEqual(len(self.pool), 1)
+        gevent.sleep(0.4)
+        self.assertEqual(len(self.pool), 0)
+
+
+class PureProxyTestCase(TestCase):
+
+    def setUp(self):
+        self.upstream = upstream()
+        self.server = PureProxy(('127.0.0.1', 0),
+                                upstream=('127.0.0.1', self.upstream.server_port))
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.server.stop()
+        self.upstream.stop()
+
+    @connect
+    def test_proxy(self):
+        for i in xrange(3):
+            run(self.sm.sendmail, 'test@gsmtpd.org', ['test@gsmtp.org'],
+                'Subject: %d\r\n\r\nbody' % i)
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(len(self.upstream.messages), 3)
+        self.assertTrue('X-Peer: 127.0.0.1' in self.upstream.messages[0][2])
+
+    @connect
+    def test_spooled(self):
+        self.server.spool_threshold = 10
+        body = 'x' * 100
+        run(self.sm.sendmail, 'test@gsmtpd.org', ['test@gsmtp.org'],
+            'Subject: spooled\r\n\r\n' + body)
+        self.assertEqual(self.upstream.messages[0][2],
+                         'Subject: spooled\nX-Peer: 127.0.0.1\n\n' + body)
+
+    def test_upstream_required(self):
+        self.assertRaises(ValueError, PureProxy, ('127.0.0.1', 0))
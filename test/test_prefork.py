@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import signal
+import smtplib
+import socket
+import subprocess
+import sys
+import time
+
+from .greentest import TestCase
+from gsmtpd.prefork import PreforkServer
+
+__all__ = ['PreforkServerTestCase']
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SUPERVISOR = '''
+from gevent import monkey
+monkey.patch_all()
+import sys
+from gsmtpd.server import SMTPServer
+from gsmtpd.prefork import PreforkServer
+
+class PidServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        import os
+        return '250 %d' % os.getpid()
+
+PreforkServer(PidServer(('127.0.0.1', int(sys.argv[1]))),
+              workers=2, reuse_port=sys.argv[2] == '1').serve_forever()
+'''
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PreforkServerTestCase(TestCase):
+
+    __timeout__ = 30
+
+    def supervise(self, reuse_port):
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, '-c', SUPERVISOR,
+                                 str(port), str(int(reuse_port))],
+                                cwd=root_path)
+        try:
+            pids = set()
+            for _ in range(100):
+                try:
+                    sm = smtplib.SMTP('127.0.0.1', port)
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+            for _ in range(20):
+                sm = smtplib.SMTP('127.0.0.1', port)
+                sm.ehlo()
+                sm.mail('test@gsmtpd.org')
+                sm.rcpt('test@gsmtp.org')
+                code, pid = sm.data('TESTMAIL')
+                self.assertEqual(code, 250)
+                pids.add(int(pid))
+                sm.quit()
+            self.assertFalse(proc.pid in pids)
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            for _ in range(100):
+                if proc.poll() is not None:
+                    break
+                time.sleep(0.05)
+            else:
+                proc.kill()
+        self.assertEqual(proc.returncode, 0)
+
+    def test_journal_dir(self):
+        self.assertEqual(PreforkServer.journal_dir('/var/spool/gsmtpd', 1),
+                         '/var/spool/gsmtpd/worker-1')
+
+    def test_reuse_port(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.skipTest('SO_REUSEPORT is not available')
+        self.supervise(True)
+
+    def test_shared_socket(self):
+        self.supervise(False)
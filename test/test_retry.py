@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import shutil
+import smtplib
+import tempfile
+
+import gevent
+
+from .greentest import TestCase
+from .utils import connect, run
+from .test_pool import upstream
+from gsmtpd.server import PureProxy
+from gsmtpd.retry import RetryQueue
+
+__all__ = ['RetryQueueTestCase', 'RetryProxyTestCase']
+
+TEMPFAIL = (451, 'try again later')
+
+
+class RetryQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gsmtpd-test-')
+        self.failures = 1
+        self.delivered = []
+        self.bounced = []
+        self.running = self.max_running = 0
+
+    def tearDown(self):
+        self.queue.stop()
+        shutil.rmtree(self.directory)
+
+    def deliver(self, mailfrom, rcpttos, data):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        gevent.sleep(0.01)
+        self.running -= 1
+        if self.failures:
+            self.failures -= 1
+            return dict((rcpt, TEMPFAIL) for rcpt in rcpttos)
+        self.delivered.append((mailfrom, rcpttos, data))
+        return {}
+
+    def bounce(self, deferred, data):
+        self.bounced.append((deferred.rcpttos, deferred.errors))
+
+    def start(self, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        self.queue = RetryQueue(self.directory, self.deliver, self.bounce,
+                                **kwargs)
+        self.queue.start()
+
+    def test_retry(self):
+        self.start()
+        self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        gevent.sleep(0.2)
+        self.assertEqual(self.delivered, [('a@gsmtpd.org', ['b@gsmtpd.org'], 'data')])
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(self.queue.stats()['delivered'], 1)
+
+    def test_persistent(self):
+        self.start(backoff=0.1)
+        self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        self.queue.stop()
+        self.failures = 0
+        self.start()
+        self.assertEqual(len(self.queue), 1)
+        gevent.sleep(0.3)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_permanent(self):
+        self.start()
+        self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': (550, 'no such user'),
+                                        'c@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        self.assertEqual(self.bounced,
+                         [(['b@gsmtpd.org'], {'b@gsmtpd.org': [550, 'no such user']})])
+        self.assertEqual(len(self.queue), 1)
+
+    def test_expire(self):
+        self.failures = 10
+        self.start(expire=0)
+        self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        gevent.sleep(0.2)
+        self.assertEqual(len(self.bounced), 1)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_unreadable(self):
+        self.start()
+        self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        entry, = self.queue.entries.values()
+        os.unlink(os.path.join(self.directory, entry.id + '.eml'))
+        gevent.sleep(0.2)
+        self.assertEqual(self.bounced,
+                         [(['b@gsmtpd.org'], {'b@gsmtpd.org': [-1, 'message data lost']})])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_orphans(self):
+        for name in ('crashed.eml', 'crashed.json.tmp'):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write('data')
+        self.start()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_concurrency(self):
+        self.failures = 0
+        self.start(concurrency=1, jitter=0)
+        for _ in xrange(3):
+            self.queue.add('a@gsmtpd.org', {'b@gsmtpd.org': TEMPFAIL}, 'data', 'mx')
+        gevent.sleep(0.2)
+        self.assertEqual(len(self.delivered), 3)
+        self.assertEqual(self.max_running, 1)
+
+
+class RetryProxyTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gsmtpd-test-')
+        self.upstream = upstream()
+        self.upstream.process_rcpt = lambda address: '451 try again later'
+        self.server = PureProxy(('127.0.0.1', 0),
+                                upstream=('127.0.0.1', self.upstream.server_port),
+                                retry_dir=self.directory, retry_backoff=0.05)
+        self.server.start()
+        self.sm = smtplib.SMTP()
+
+    def tearDown(self):
+        self.server.stop()
+        self.upstream.stop()
+        shutil.rmtree(self.directory)
+
+    @connect
+    def test_deferred(self):
+        run(self.sm.sendmail, 'test@gsmtpd.org', ['test@gsmtp.org'], 'data')
+        self.assertEqual(len(self.server.retry), 1)
+        self.assertEqual(self.upstream.messages, [])
+        self.upstream.process_rcpt = lambda address: None
+        gevent.sleep(0.3)
+        self.assertEqual(len(self.upstream.messages), 1)
+        self.assertEqual(len(self.server.retry), 0)
+
+    @connect
+    def test_bounce(self):
+        self.upstream.process_rcpt = lambda address: (
+            '550 No such user' if address.startswith('nobody') else None)
+        run(self.sm.sendmail, 'test@gsmtpd.org', ['nobody@gsmtp.org'],
+            'Subject: hello\r\n\r\ndata')
+        self.assertEqual(len(self.server.retry), 0)
+        mailfrom, rcpttos, data = self.upstream.messages[0]
+        self.assertTrue(mailfrom.startswith('<>'))
+        self.assertEqual(rcpttos, ['test@gsmtpd.org'])
+        self.assertTrue('<nobody@gsmtp.org>: 550 No such user' in data)
+        self.assertTrue('Subject: hello' in data)
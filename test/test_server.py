@@ -3,8 +3,10 @@
 
 import json
 import os
+import shutil
+import tempfile
 import gevent
-from gevent import monkey
+from gevent import monkey, socket
 monkey.patch_all()
 
 import smtplib
@@ -16,7 +18,9 @@ import logging
 
 logging.basicConfig(level=logging.ERROR)
 
-__all__ = ['SMTPServerTestCase','SimpleSMTPServerTestCase','SSLServerTestCase']
+__all__ = ['SMTPServerTestCase','SimpleSMTPServerTestCase','SSLServerTestCase',
+           'SpoolServerTestCase', 'HostnameTestCase', 'SessionLimitTestCase',
+           'SSLReloadTestCase', 'ImplicitTLSTestCase']
 root_path = os.path.dirname(os.path.abspath(__file__))
 
 class SMTPServerTestCase(TestCase):
@@ -96,6 +100,24 @@ class SMTPServerTestCase(TestCase):
         gevent.sleep(self.server.timeout+0.0001)
         self.assertEqual(run(self.sm.mail, 'hi')[0], 421)
 
+    @connect
+    def test_idle_timeout(self):
+        gevent.sleep(self.server.timeout + self.server.timers.resolution)
+        self.assertEqual(run(self.sm.getreply)[0], 421)
+
+    @connect
+    def test_session_timeout(self):
+        self.server.session_timeout = 1
+        self.server.timeout = 5
+        self.sm.close()
+        run(self.sm.connect, '127.0.0.1', self.server.server_port)
+        for _ in range(10):
+            code = run(self.sm.noop)[0]
+            if code != 250:
+                break
+            gevent.sleep(0.2)
+        self.assertEqual(code, 421)
+
 
     def tearDown(self):
         self.sm.close()
@@ -191,7 +213,241 @@ class SSLServerTestCase(TestCase):
 
         self.assertEqual(data['data'],'TESTMAIL')
 
+    @connect
+    def test_handshake_timeout(self):
+        self.server.clean()
+        self.server = TmpFileMailServer(('127.0.0.1', 0), timeout=0.1,
+                                        metrics=True,
+                                        keyfile=os.path.join(root_path, 'server.key'),
+                                        certfile=os.path.join(root_path, 'server.crt'))
+        # fire the deadline well within the time limit of the test
+        self.server.timers.resolution = 0.05
+        self.server.start()
+        sock = socket.create_connection(('127.0.0.1', self.server.server_port))
+        sock.sendall('EHLO client.example\r\nSTARTTLS\r\n')
+        replies = ''
+        while not replies.endswith('220 Ready to start TLS\r\n'):
+            replies += sock.recv(1024)
+        # no ClientHello, the server closes without a plain text reply
+        self.assertEqual(sock.recv(1024), '')
+        sock.close()
+        self.assertEqual(self.server.metrics.timeouts.get(), 1)
+
     def tearDown(self):
 
         self.sm.close()
         self.server.clean()
+
+
+
+class ImplicitTLSTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = TmpFileMailServer(('127.0.0.1', 0),
+                                        smtps_localaddr=('127.0.0.1', 0),
+                                        keyfile=os.path.join(root_path, 'server.key'),
+                                        certfile=os.path.join(root_path, 'server.crt'))
+        self.server.start()
+
+    def test_smtps(self):
+        sm = smtplib.SMTP_SSL('127.0.0.1', self.server.smtps_server.server_port)
+        self.assertEqual(run(sm.ehlo)[0], 250)
+        self.assertNotIn('starttls', sm.esmtp_features)
+        sm.sendmail('test@example', ['aa@bb.com'], 'TESTMAIL')
+        sm.close()
+        with open(self.server.tmp) as f:
+            self.assertEqual(json.loads(f.read())['data'], 'TESTMAIL')
+
+    def test_plain(self):
+        sm = smtplib.SMTP('127.0.0.1', self.server.server_port)
+        run(sm.ehlo)
+        self.assertIn('starttls', sm.esmtp_features)
+        sm.close()
+
+    def test_not_tls(self):
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.server.smtps_server.server_port))
+        sock.sendall('EHLO plain.example\r\n')
+        try:
+            # at most a TLS alert, never the banner
+            self.assertFalse(sock.recv(1024).startswith('220'))
+        except socket.error:
+            pass
+        sock.close()
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.sessions, 0)
+
+    def test_handshake_timeout(self):
+        self.server.stop()
+        events = []
+        self.server = TmpFileMailServer(('127.0.0.1', 0),
+                                        smtps_localaddr=('127.0.0.1', 0),
+                                        greeting_timeout=0.1, metrics=True,
+                                        keyfile=os.path.join(root_path, 'server.key'),
+                                        certfile=os.path.join(root_path, 'server.crt'))
+        self.server.on_connect = lambda sc, ts: events.append('connect')
+        self.server.on_close = lambda sc, ts: events.append('close')
+        # fire the deadline well within the time limit of the test
+        self.server.timers.resolution = 0.05
+        self.server.start()
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.server.smtps_server.server_port))
+        # no ClientHello, the server gives up
+        self.assertEqual(sock.recv(1024), '')
+        sock.close()
+        gevent.sleep(0.01)
+        self.assertEqual(events, ['connect', 'close'])
+        self.assertEqual(self.server.metrics.timeouts.get(), 1)
+        self.assertEqual(self.server.sessions, 0)
+
+    def test_needs_certificate(self):
+        self.assertRaises(ValueError, SMTPServer, ('127.0.0.1', 0),
+                          implicit_tls=True)
+
+    def tearDown(self):
+
+        self.server.stop()
+        self.server.clean()
+
+
+class SSLReloadTestCase(TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp(prefix='gsmtpd-test-')
+        self.keyfile = os.path.join(self.directory, 'server.key')
+        self.certfile = os.path.join(self.directory, 'server.crt')
+        shutil.copy(os.path.join(root_path, 'server.key'), self.keyfile)
+        shutil.copy(os.path.join(root_path, 'server.crt'), self.certfile)
+        self.server = SMTPServer(('127.0.0.1', 0), ssl_reload=0.05,
+                                 keyfile=self.keyfile, certfile=self.certfile)
+        self.server.start()
+
+    def test_shared_context(self):
+        self.sm = smtplib.SMTP()
+        context = self.server.ssl_context
+        for _ in range(2):
+            run(self.sm.connect, '127.0.0.1', self.server.server_port)
+            run(self.sm.ehlo)
+            self.assertEqual(run(self.sm.starttls)[0], 220)
+            run(self.sm.ehlo)
+            self.sm.close()
+        self.assertTrue(self.server.ssl_context is context)
+        self.assertEqual(context.session_stats()['accept_good'], 2)
+
+    def test_reload(self):
+        context = self.server.ssl_context
+        later = os.stat(self.certfile).st_mtime + 10
+        os.utime(self.certfile, (later, later))
+        gevent.sleep(0.2)
+        self.assertFalse(self.server.ssl_context is context)
+
+    def test_broken_certificate(self):
+        context = self.server.ssl_context
+        with open(self.certfile, 'w') as f:
+            f.write('half written')
+        gevent.sleep(0.2)
+        self.assertTrue(self.server.ssl_context is context)
+
+    def tearDown(self):
+
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+class SpoolServer(SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.type = type(data)
+        self.data = data[:]
+
+class SpoolServerTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = SpoolServer(('127.0.0.1', 0), spool_threshold=64)
+        self.server.start()
+        gevent.sleep(0.01)
+        self.sm = smtplib.SMTP()
+
+    @connect
+    def test_memory(self):
+        self.sm.sendmail('test@example', ['aa@bb.com'], 'TESTMAIL')
+        self.assertEqual(self.server.type, str)
+        self.assertEqual(self.server.data, 'TESTMAIL')
+
+    @connect
+    def test_spooled(self):
+        import mmap
+        data = '\r\n'.join(['spooled line %d' % i for i in range(1000)])
+        self.sm.sendmail('test@example', ['aa@bb.com'], data)
+        self.assertEqual(self.server.type, mmap.mmap)
+        self.assertEqual(self.server.data, data.replace('\r\n', '\n'))
+
+    def tearDown(self):
+
+        self.sm.close()
+
+
+class HostnameTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = SMTPServer(('127.0.0.1', 0), hostname='mx.gsmtpd.org')
+        self.server.start()
+        gevent.sleep(0.01)
+        self.sm = smtplib.SMTP()
+
+    def test_banner(self):
+        code, banner = run(self.sm.connect, '127.0.0.1', self.server.server_port)
+        self.assertEqual(code, 220)
+        self.assertTrue(banner.startswith('mx.gsmtpd.org '))
+        self.assertEqual(run(self.sm.helo), (250, 'mx.gsmtpd.org'))
+
+    def tearDown(self):
+
+        self.sm.close()
+        self.server.stop()
+
+
+class SessionLimitTestCase(TestCase):
+
+    def setUp(self):
+
+        self.server = SMTPServer(('127.0.0.1', 0), max_sessions=2,
+                                 max_sessions_per_ip=1)
+        self.server.start()
+        gevent.sleep(0.01)
+        self.clients = []
+
+    def connect(self):
+        sm = smtplib.SMTP()
+        self.clients.append(sm)
+        return run(sm.connect, '127.0.0.1', self.server.server_port)[0]
+
+    def test_per_ip(self):
+        self.assertEqual(self.connect(), 220)
+        self.assertEqual(self.server.stats()['sessions'], 1)
+        self.assertEqual(self.connect(), 421)
+        self.assertEqual(self.server.stats()['rejected'], 1)
+
+    def test_total(self):
+        self.server.max_sessions_per_ip = None
+        self.assertEqual(self.connect(), 220)
+        self.assertEqual(self.connect(), 220)
+        self.assertEqual(self.connect(), 421)
+        run(self.clients[0].quit)
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.stats()['sessions'], 1)
+        self.assertEqual(self.connect(), 220)
+
+    def test_loop_lag(self):
+        self.server.loop_lag = 1
+        self.server.max_loop_lag = 0.5
+        self.assertEqual(self.connect(), 421)
+
+    def tearDown(self):
+
+        for sm in self.clients:
+            sm.close()
+        self.server.stop()
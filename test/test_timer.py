@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+import gevent
+
+from .greentest import TestCase
+from gsmtpd.timer import TimerWheel
+
+__all__ = ['TimerWheelTestCase']
+
+
+class Entry(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.timer_slot = None
+        self.expired = 0
+
+    def expire(self):
+        self.expired += 1
+
+
+class TimerWheelTestCase(TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=1)
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def test_expire(self):
+        early, late = Entry(100.5), Entry(105.5)
+        self.wheel.schedule(early)
+        self.wheel.schedule(late)
+        self.wheel.expire(100.9)
+        self.assertEqual(early.expired, 0)
+        self.wheel.expire(101.0)
+        self.assertEqual((early.expired, late.expired), (1, 0))
+        self.wheel.expire(110)
+        self.assertEqual((early.expired, late.expired), (1, 1))
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_postpone(self):
+        entry = Entry(100.5)
+        self.wheel.schedule(entry)
+        entry.deadline = 103.5
+        self.wheel.schedule(entry)
+        self.assertEqual(entry.timer_slot, 101)
+        self.wheel.expire(101)
+        self.assertEqual((entry.expired, entry.timer_slot), (0, 104))
+        self.wheel.expire(104)
+        self.assertEqual(entry.expired, 1)
+
+    def test_advance(self):
+        entry = Entry(105.5)
+        self.wheel.schedule(entry)
+        entry.deadline = 100.5
+        self.wheel.schedule(entry)
+        self.wheel.expire(101)
+        self.assertEqual(entry.expired, 1)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_disarm_and_cancel(self):
+        disarmed, cancelled = Entry(100.5), Entry(100.5)
+        self.wheel.schedule(disarmed)
+        self.wheel.schedule(cancelled)
+        disarmed.deadline = None
+        self.wheel.cancel(cancelled)
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.expire(102)
+        self.assertEqual((disarmed.expired, cancelled.expired), (0, 0))
+
+    def test_runner(self):
+        wheel = self.wheel = TimerWheel(resolution=0.05)
+        entry = Entry(time.time() + 0.1)
+        wheel.schedule(entry)
+        gevent.sleep(0.3)
+        self.assertEqual(entry.expired, 1)
+        self.assertEqual(wheel._runner, None)
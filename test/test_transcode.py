@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import random
+
+from .greentest import TestCase
+from gsmtpd.transcode import unstuff, Unstuffer
+
+__all__ = ['TranscodeTestCase']
+
+
+def reference(data):
+    # the line by line loop SMTPChannel used to run
+    lines = []
+    for text in data.split('\r\n'):
+        if text and text[0] == '.':
+            lines.append(text[1:])
+        else:
+            lines.append(text)
+    return '\n'.join(lines)
+
+
+SAMPLES = [
+    '',
+    '.',
+    'TESTMAIL',
+    '.hidden\r\n..dot\r\nplain.\r\n',
+    'a\r\n.\r\n.b\r\n\r\n..',
+    'lone\rcr\nand lf\r\r\n.x\r',
+    '\r\n.\r\n\r\n.',
+]
+
+
+class TranscodeTestCase(TestCase):
+
+    def test_unstuff(self):
+        for data in SAMPLES:
+            self.assertEqual(unstuff(data), reference(data))
+
+    def test_every_split(self):
+        for data in SAMPLES:
+            for i in range(len(data) + 1):
+                for j in range(i, len(data) + 1):
+                    unstuffer = Unstuffer()
+                    out = [unstuffer.feed(part)
+                           for part in (data[:i], data[i:j], data[j:])]
+                    out.append(unstuffer.flush())
+                    self.assertEqual(''.join(out), reference(data),
+                                     (data, i, j))
+
+    def test_random_chunks(self):
+        rand = random.Random(2821)
+        data = ''.join(rand.choice(['.', '\r', '\n', '\r\n', '\r\n.', 'x'])
+                       for _ in range(5000))
+        unstuffer = Unstuffer()
+        out, i = [], 0
+        while i < len(data):
+            n = rand.randint(1, 64)
+            out.append(unstuffer.feed(data[i:i + n]))
+            i += n
+        out.append(unstuffer.flush())
+        self.assertEqual(''.join(out), reference(data))
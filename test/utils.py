@@ -13,3 +13,31 @@ def run(func, *args):
     task = gevent.spawn(func, *args)
     task.run()
     return task.value
+
+
+class FakeSocket(object):
+    """In-memory socket, reads the given chunks and records every send"""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+        self.closed = False
+
+    def getpeername(self):
+        return ('127.0.0.1', 2525)
+
+    def recv_into(self, view, size):
+        if not self.chunks:
+            return 0
+        data = self.chunks.pop(0)
+        if len(data) > size:
+            self.chunks.insert(0, data[size:])
+            data = data[:size]
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True